@@ -5,12 +5,13 @@ an interactive system to save, edit & query file tags.
 
 import argparse
 from cmd import Cmd
+import itertools
 import os
 import tempfile
 
 import f_manager as file_manager
+from file_manager import query
 from file_manager import utils
-from file_manager import mdata
 
 class CmdArgparseWrapper(object):
     def __init__(self, parser):
@@ -51,7 +52,10 @@ class CmdArgparseWrapper(object):
 class FileManagerCmd(Cmd, object):
     """Cmd interface for file_system.py"""
 
+    # file_list holds the current page of results, file_iter yields the following ones
     file_list = []
+    file_iter = iter(())
+    page_size = 50
     is_dirty = False
 
     def __init__(self):
@@ -61,12 +65,21 @@ class FileManagerCmd(Cmd, object):
 
         file_manager.init()
 
+    def postcmd(self, stop, line):
+        """Sync the journal before waiting for the next command, as it may take a while."""
+
+        file_manager.sync_journal(force=True)
+        return stop
+
     def do_save(self, args):
         """Save modifications to .mdata and .dbconfig files."""
 
         file_manager.save()
         self.is_dirty = False
 
+        report = file_manager.last_save_report
+        print "Saved {} records in {:.3f}s.".format(report.records, report.elapsed)
+
     __tag_parser = argparse.ArgumentParser(prog="tag")
     __tag_parser.add_argument("path", help="a full path to a file/folder. Use | to indicate spaces in the path")
     __tag_parser.add_argument("mode", choices=["add", "remove"], help="either 'add' (to add the provided tags to the path) " \
@@ -105,20 +118,79 @@ class FileManagerCmd(Cmd, object):
 
         self.is_dirty = True
 
+    __bulk_tag_parser = argparse.ArgumentParser(prog="bulk_tag")
+    __bulk_tag_parser.add_argument("mode", choices=["add", "remove"], help="either 'add' (to add the provided tags to the paths) " \
+                                                                         "or 'remove' (to remove the provided tags to the paths)")
+    __bulk_tag_parser.add_argument("tags", nargs="*", help="a space-separated list of tags")
+    __bulk_tag_parser.add_argument("-p", "--paths", nargs="+", default=[], help="paths or glob patterns (e.g. C:\\photos\\*.jpg). " \
+                                                                              "Use | to indicate spaces in the paths")
+    __bulk_tag_parser.add_argument("-f", "--from_file", default=None, help="a text file with one path or glob pattern per line")
+    __bulk_tag_parser.add_argument("-r", "--recursive", action="store_true", help="tag all the files inside the provided folders, " \
+                                                                                "at any depth, instead of the folders themselves")
+
+    @CmdArgparseWrapper(parser=__bulk_tag_parser)
+    def do_bulk_tag(self, args, parsed):
+        """
+        bulk_tag [mode] [tag(s)] [-p path(s)] [-f from_file] [-r]
+        [mode] : either 'add' (to add the provided tags to the paths)
+                 or 'remove' (to remove the provided tags to the paths)
+        [tag(s)] : a space-separated list of tags
+        [path(s)] : paths or glob patterns (e.g. C:\\photos\\*.jpg). Use | to indicate spaces in the paths
+        [from_file] : a text file with one path or glob pattern per line
+        [-r] : tag all the files inside the provided folders, at any depth, instead of the folders themselves
+
+        Modify tags for many files and folders at once
+        """
+
+        patterns = [p.replace("|", " ") for p in parsed.paths]
+
+        if parsed.from_file:
+            try:
+                with open(parsed.from_file.replace("|", " "), "r") as paths_file:
+                    patterns.extend(line.strip() for line in paths_file if line.strip())
+            except IOError as e:
+                print "Error: unable to read paths from <{}> - {}".format(parsed.from_file, e)
+                return
+
+        if not patterns:
+            print "Error: no path provided. Use -p and/or -f to provide the paths to tag."
+            return
+
+        mode = utils.TAGMODE.ADD if parsed.mode == "add" else utils.TAGMODE.REMOVE
+
+        report = file_manager.bulk_tag(patterns, mode, *parsed.tags, recursive=parsed.recursive)
+
+        print "Tagged {} files and {} folders in {:.3f}s ({:.0f} files/s).{}".format(report.files, report.folders, report.elapsed,
+                                                                                   (report.files + report.folders) / max(report.elapsed, 1e-6),
+                                                                                   " {} paths skipped.".format(report.errors) if report.errors else "")
+
+        self.is_dirty = True
+
     __filter_parser = argparse.ArgumentParser(prog="filter")
     __filter_parser.add_argument("mode", choices=["all", "any"], help=" either 'all' (to return only files that match all provided tags) " \
                                                                         "or 'any' (to return all files that match any of the provided tags)")
-    __filter_parser.add_argument("tags", nargs="*", help="a space-separated list of tags")
+    __filter_parser.add_argument("tags", nargs="*", help="a space-separated list of tags (proj* matches any tag starting with proj)")
+    __filter_parser.add_argument("-l", "--limit", type=int, default=page_size, help="the number of results to print (0 to print all of them)")
+    __filter_parser.add_argument("-o", "--offset", type=int, default=0, help="the number of results to skip")
+    __filter_parser.add_argument("-d", "--dirs", action="store_true", help="return matching folders as a single result instead of the files they contain")
+    __filter_parser.add_argument("-s", "--sort", choices=sorted(file_manager.SORT_KEYS), default=None,
+                                 help="order the results by last modification or creation time (most recent first), size (largest first) or name")
 
     @CmdArgparseWrapper(parser=__filter_parser)
     def do_filter(self, args, parsed):
         """
-        filter [mode] [tag(s)]
+        filter [mode] [tag(s)] [-l limit] [-o offset] [-d] [-s sort]
         [mode] : either 'all' (to return only files that match all provided tags)
                  or 'any' (to return all files that match any of the provided tags)
-        [tag(s)] : a space-separated list of tags
-
-        Returns a list of files matching the provided 'tag(s)' using 'mode'.
+        [tag(s)] : a space-separated list of tags, tags ending with * match any tag starting with the rest (e.g. proj*)
+        [limit] : the number of results to print (0 to print all of them)
+        [offset] : the number of results to skip
+        [-d] : return matching folders as a single result instead of the files they contain
+        [sort] : order the results by 'mtime' or 'ctime' (most recent first), 'size' (largest first) or 'name'.
+                 The first pages are found without sorting all the results
+
+        Returns a page of files matching the provided 'tag(s)' using 'mode'. Use 'more' to get the next page.
+        Tags can be completed with Tab, unknown tags get spelling suggestions.
         """
         
         mode = parsed.mode
@@ -132,11 +204,171 @@ class FileManagerCmd(Cmd, object):
         
         tags = parsed.tags
 
-        flist = file_manager.get_files_for_tags(mode, *tags)
-        self.file_list = [md.fpath if isinstance(md, mdata.MData) else md for md in flist]
+        self.file_iter = file_manager.iter_files_for_tags(mode, *tags, expand_dirs=not parsed.dirs)
+        if parsed.sort:
+            self.file_iter = file_manager.iter_sorted_paths(self.file_iter, parsed.sort)
+
+        if not self.print_page(parsed.limit, parsed.offset) and not parsed.offset:
+            print "No match found for tags {} with mode {}".format(tags, mode)
+            self.print_suggestions(tags)
+
+    __cache_stats_parser = argparse.ArgumentParser(prog="cache_stats")
+    __cache_stats_parser.add_argument("-c", "--clear", action="store_true", help="empty the cache and reset the counters")
+
+    @CmdArgparseWrapper(parser=__cache_stats_parser)
+    def do_cache_stats(self, args, parsed):
+        """
+        cache_stats [-c]
+        [-c] : empty the cache and reset the counters
+
+        Prints the number of hits and misses of the 'filter' results cache and of the folder listings cache
+        """
+
+        for name, cache in (("filter results", file_manager.query_cache), ("folder listings", file_manager.listing_cache)):
+            stats = cache.stats()
+            lookups = stats["hits"] + stats["misses"]
+
+            print "{}: hits: {} misses: {} ({:.1f}% hit rate) cached: {}/{}".format(name, stats["hits"], stats["misses"],
+                                                                                100.0 * stats["hits"] / lookups if lookups else 0.0,
+                                                                                stats["entries"], stats["max_entries"])
+
+            if parsed.clear:
+                cache.clear()
+
+    __query_parser = argparse.ArgumentParser(prog="query")
+    __query_parser.add_argument("expression", nargs="+", help="a boolean combination of tags using AND, OR, NOT and parentheses")
+    __query_parser.add_argument("-l", "--limit", type=int, default=page_size, help="the number of results to print (0 to print all of them)")
+    __query_parser.add_argument("-o", "--offset", type=int, default=0, help="the number of results to skip")
+    __query_parser.add_argument("-d", "--dirs", action="store_true", help="return matching folders as a single result instead of the files they contain")
+    __query_parser.add_argument("-s", "--sort", choices=sorted(file_manager.SORT_KEYS), default=None,
+                                help="order the results by last modification or creation time (most recent first), size (largest first) or name")
+
+    @CmdArgparseWrapper(parser=__query_parser)
+    def do_query(self, args, parsed):
+        """
+        query [expression] [-l limit] [-o offset] [-d] [-s sort]
+        [expression] : a boolean combination of tags using AND, OR, NOT and parentheses.
+                       Adjacent tags are joined with AND, use double quotes for tags with spaces.
+                       Tags ending with * match any tag starting with the rest (e.g. proj*).
+                       Files can also be filtered by size, modified or created date with <, <=, >, >=, =
+                       e.g. size>100MB, modified<2023-01-01, created>=2023-06-01T12:00
+        [limit] : the number of results to print (0 to print all of them)
+        [offset] : the number of results to skip
+        [-d] : return matching folders as a single result instead of the files they contain
+        [sort] : order the results by 'mtime' or 'ctime' (most recent first), 'size' (largest first) or 'name'.
+                 The first pages are found without sorting all the results
+
+        Returns a page of files matching the provided 'expression', e.g. (photo AND 2023) AND NOT raw AND size>10MB.
+        Use 'more' to get the next page.
+        """
+
+        expression = " ".join(parsed.expression)
+
+        self.file_iter = file_manager.iter_files_for_query(expression, expand_dirs=not parsed.dirs)
+        if parsed.sort:
+            self.file_iter = file_manager.iter_sorted_paths(self.file_iter, parsed.sort)
+
+        if not self.print_page(parsed.limit, parsed.offset) and not parsed.offset:
+            print "No match found for query '{}'".format(expression)
+
+            try:
+                self.print_suggestions(query.get_tags(query.Query(expression).tree))
+            except ValueError:
+                # the error was already reported by the query
+                pass
+
+    __more_parser = argparse.ArgumentParser(prog="more")
+    __more_parser.add_argument("-l", "--limit", type=int, default=page_size, help="the number of results to print (0 to print all of them)")
+
+    @CmdArgparseWrapper(parser=__more_parser)
+    def do_more(self, args, parsed):
+        """
+        more [-l limit]
+        [limit] : the number of results to print (0 to print all of them)
+
+        Prints the next page of results of the last 'filter' or 'query'
+        """
+
+        if not self.print_page(parsed.limit):
+            print "No more results."
+
+    def print_page(self, limit, offset=0):
+        """Fetch the next 'limit' results (all of them if 0) after skipping 'offset' ones, and print them.
+        The page replaces file_list. Returns the number of results printed."""
+
+        stop = offset + limit if limit > 0 else None
+        self.file_list = list(itertools.islice(self.file_iter, offset, stop))
+
+        for fpath in self.file_list:
+            print fpath
+
+        if limit > 0 and len(self.file_list) == limit:
+            print "-- {} results shown, type 'more' for the next ones --".format(limit)
+
+        return len(self.file_list)
+
+    def print_suggestions(self, tags):
+        """Print the tags in use with a similar spelling for the tags in 'tags' which aren't used."""
+
+        for t in tags:
+            if query.is_prefix(t) or file_manager.is_tag_used(t):
+                continue
+
+            suggestions = file_manager.suggest_tags(t)
+            if suggestions:
+                print "Unknown tag '{}', did you mean {}?".format(t, " or ".join("'{}'".format(s) for s in suggestions))
+            else:
+                print "Unknown tag '{}'".format(t)
+
+    # options followed by a value, for each command with tags completion
+    __value_options = ("-l", "--limit", "-o", "--offset", "-s", "--sort")
+
+    def __complete_args(self, text, line, begidx, choices):
+        """Returns the completions for the argument 'text' of 'line': the values in choices[i] for the i-th positional argument
+        (nothing if choices[i] is None), the tags in use for the following ones."""
 
-        print self.file_list if len(self.file_list) > 0 else "No match found for tags {} with mode {}".format(tags, mode)
+        words = line[:begidx].split()[1:]
+        if text.startswith("-") or (words and words[-1] in self.__value_options and words[-1] not in ("-s", "--sort")):
+            return []
 
+        if words and words[-1] in ("-s", "--sort"):
+            return [k for k in sorted(file_manager.SORT_KEYS) if k.startswith(text)]
+
+        # count the positional arguments before text, skipping the options and their values
+        position = 0
+        for previous, word in zip([None] + words, words):
+            if not (word.startswith("-") or previous in self.__value_options):
+                position += 1
+
+        if position < len(choices):
+            return [c for c in choices[position] or [] if c.startswith(text)]
+
+        return file_manager.complete_tags(text)
+
+    def complete_tag(self, text, line, begidx, endidx):
+        """Complete the mode and tags of 'tag'."""
+
+        return self.__complete_args(text, line, begidx, [None, ["add", "remove"]])
+
+    def complete_filter(self, text, line, begidx, endidx):
+        """Complete the mode and tags of 'filter'."""
+
+        return self.__complete_args(text, line, begidx, [["all", "any"]])
+
+    def complete_query(self, text, line, begidx, endidx):
+        """Complete the tags of 'query'."""
+
+        return self.__complete_args(text, line, begidx, [])
+
+    def do_explain(self, args):
+        """
+        explain [expression]
+        [expression] : a boolean combination of tags, as accepted by 'query'
+
+        Prints the execution plans for 'expression' with the estimated number of matching folders and files
+        """
+
+        print file_manager.explain_query(args)
 
     def do_open(self, args):
         """
@@ -188,6 +420,111 @@ class FileManagerCmd(Cmd, object):
 
         self.is_dirty = True
 
+    __lazy_load_parser = argparse.ArgumentParser(prog="lazy_load")
+    __lazy_load_parser.add_argument("mode", choices=["on", "off"], help="either 'on' (to load folders metadata on first access) " \
+                                                                      "or 'off' (to load the whole database on startup)")
+    __lazy_load_parser.add_argument("-mf", "--max_folders", type=int, nargs="?", default=None,
+                                    help="the maximum number of folders to keep in memory when lazy loading is on")
+
+    @CmdArgparseWrapper(parser=__lazy_load_parser)
+    def do_lazy_load(self, args, parsed):
+        """
+        lazy_load [mode] [max_folders]
+        [mode] : either 'on' (to load folders metadata on first access)
+                 or 'off' (to load the whole database on startup)
+        [max_folders] : the maximum number of folders to keep in memory when lazy loading is on
+
+        Sets the loading mode for the database. The setting is saved in the config file.
+        """
+
+        file_manager.set_lazy_load(parsed.mode == "on", parsed.max_folders)
+
+        self.is_dirty = True
+
+    __load_workers_parser = argparse.ArgumentParser(prog="load_workers")
+    __load_workers_parser.add_argument("threads", type=int, help="the number of threads reading the metadata when the database is loaded")
+    __load_workers_parser.add_argument("-p", "--processes", type=int, nargs="?", default=None,
+                                       help="the number of processes decoding the metadata (0 to decode it in the main process)")
+
+    @CmdArgparseWrapper(parser=__load_workers_parser)
+    def do_load_workers(self, args, parsed):
+        """
+        load_workers [threads] [processes]
+        [threads] : the number of threads reading the metadata when the database is loaded
+        [processes] : the number of processes decoding the metadata (0 to decode it in the main process)
+
+        Sets the worker pools used to load the database. The setting is saved in the config file.
+        """
+
+        file_manager.set_load_workers(parsed.threads, parsed.processes)
+
+        self.is_dirty = True
+
+    __refresh_stats_parser = argparse.ArgumentParser(prog="refresh_stats")
+    __refresh_stats_parser.add_argument("folder_path", nargs="?", default=None,
+                                        help="full path to a specific folder (if empty, all the folders are refreshed)")
+    __refresh_stats_parser.add_argument("-f", "--force", action="store_true", help="refresh the stat data even if it's not stale")
+    __refresh_stats_parser.add_argument("-ma", "--max_age", type=float, nargs="?", default=None,
+                                        help="the age in seconds after which the stat data is refreshed on access (negative to only refresh it on demand)")
+
+    @CmdArgparseWrapper(parser=__refresh_stats_parser)
+    def do_refresh_stats(self, args, parsed):
+        """
+        refresh_stats [folder_path] [-f] [-ma max_age]
+        [folder_path] : full path to a specific folder (if empty, all the folders are refreshed)
+        [-f] : refresh the stat data even if it's not stale
+        [-ma max_age] : the age in seconds after which the stat data is refreshed on access
+                        (negative to only refresh it on demand), saved in the config file
+
+        Refreshes the times and sizes of the tagged files, with a single scan per folder.
+        """
+
+        if parsed.max_age is not None:
+            file_manager.set_stat_max_age(parsed.max_age if parsed.max_age >= 0 else None)
+            self.is_dirty = True
+
+        print "Refreshed {} records.".format(file_manager.refresh_stats(parsed.folder_path, parsed.force))
+
+    __recursive_tags_parser = argparse.ArgumentParser(prog="recursive_tags")
+    __recursive_tags_parser.add_argument("mode", choices=["on", "off"], help="either 'on' (folders inherit the tags of all their ancestors) " \
+                                                                           "or 'off' (folder tags only apply to the files directly inside them)")
+
+    @CmdArgparseWrapper(parser=__recursive_tags_parser)
+    def do_recursive_tags(self, args, parsed):
+        """
+        recursive_tags [mode]
+        [mode] : either 'on' (folders inherit the tags of all their ancestors)
+                 or 'off' (folder tags only apply to the files directly inside them)
+
+        Sets how folder tags apply to subfolders. The setting is saved in the config file.
+        """
+
+        file_manager.set_recursive_tags(parsed.mode == "on")
+
+        self.is_dirty = True
+
+    __migrate_store_parser = argparse.ArgumentParser(prog="migrate_store")
+    __migrate_store_parser.add_argument("storage", choices=["files", "sqlite"], help="either 'files' (to store metadata as one .mdata file per file) " \
+                                                                                   "or 'sqlite' (to store all metadata into a single database file)")
+
+    @CmdArgparseWrapper(parser=__migrate_store_parser)
+    def do_migrate_store(self, args, parsed):
+        """
+        migrate_store [storage]
+        [storage] : either 'files' (to store metadata as one .mdata file per file)
+                    or 'sqlite' (to store all metadata into a single database file)
+
+        Moves all the metadata to the provided storage. Changes are saved right away.
+        """
+
+        if parsed.storage == "files":
+            storage = utils.STORAGE.FILES
+        else:
+            storage = utils.STORAGE.SQLITE
+
+        if file_manager.migrate_store(storage):
+            self.is_dirty = False
+
     __init_with_hwID_parser = argparse.ArgumentParser(prog="init_with_hwID")
     __init_with_hwID_parser.add_argument("hardware_id", help=" the old hardware ID with which the config file was encrypted with")
 
@@ -220,11 +557,24 @@ class FileManagerCmd(Cmd, object):
         if self.is_dirty:
             self.do_save(args)
 
+        file_manager.close()
+
         print "Quitting."
         raise SystemExit
 
 def main():
-    """Instantiate the FileManagerCmd class and start the main loop"""
+    """Instantiate the FileManagerCmd class and start the main loop, or start the server if --serve is provided"""
+
+    parser = argparse.ArgumentParser(prog="file_manager")
+    parser.add_argument("--serve", action="store_true", help="keep the database loaded and serve requests from daemon.Client " \
+                                                             "instead of starting an interactive session")
+    parser.add_argument("--socket", default=None, help="the socket file path for the server (defaults to a file inside the database folder)")
+    parsed = parser.parse_args()
+
+    if parsed.serve:
+        import daemon
+        daemon.serve(parsed.socket)
+        return
 
     prompt = FileManagerCmd()
     prompt.prompt = '> '
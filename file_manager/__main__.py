@@ -4,4 +4,6 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from . import main
 
-main()
\ No newline at end of file
+# the guard lets multiprocessing workers import this module without starting a session
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""
+This module contains the QueryCache class, a LRU cache for the results of tag queries,
+and the DirListingCache class, a LRU cache for the content of folders.
+
+Each cached result records the tags it depends on, so that a tag modification only
+invalidates the results of the queries using that tag. Folder listings are refreshed
+when the folder mtime changes.
+
+e.g.
+
+import cache
+
+query_cache = cache.QueryCache(max_entries=128)
+
+# key the results by filter mode and tags
+key = query_cache.make_key(utils.FILTERMODE.ALL, "text", "important")
+query_cache.put(key, [r'C:\test_mdata_file.txt'], ["text", "important"])
+
+# returns [r'C:\test_mdata_file.txt']
+print query_cache.get(key)
+
+# a modification of the "important" tag drops the result
+query_cache.invalidate(["important"])
+
+listing_cache = cache.DirListingCache()
+
+# lists the folder the first time, then only checks its mtime
+print listing_cache.listdir(r'C:\test_folder')
+
+# only the files, without the subfolders
+print listing_cache.listfiles(r'C:\test_folder')
+
+Classes:
+    DirListingCache
+    QueryCache
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+try:
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve the utils module
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import utils
+
+class QueryCache(object):
+    """LRU cache { key : result } with tag-based invalidation."""
+
+    def __init__(self, max_entries=128):
+        """Initialize an empty cache holding at most 'max_entries' results (0 disables the cache)."""
+
+        self.max_entries = max_entries
+
+        # key -> (result, tags), least recently used first
+        self.entries = OrderedDict()
+        # tag -> set of keys depending on it
+        self.dependents = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def make_key(mode, *tags):
+        """Returns the normalized key for a filter query: the result doesn't depend on the order or repetition of tags."""
+
+        return (mode, tuple(sorted(set(tags))))
+
+    def get(self, key):
+        """Returns the result cached for key, or None if it's not cached."""
+
+        try:
+            result, tags = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # mark it as the most recently used
+        self.entries[key] = (result, tags)
+        self.hits += 1
+
+        return result
+
+    def put(self, key, result, tags):
+        """Cache result for key, until one of 'tags' is modified."""
+
+        if self.max_entries <= 0:
+            return
+
+        self.discard(key)
+
+        tags = frozenset(tags)
+        self.entries[key] = (result, tags)
+        for t in tags:
+            self.dependents.setdefault(t, set()).add(key)
+
+        while len(self.entries) > self.max_entries:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """Remove the result cached for key, if any."""
+
+        try:
+            _, tags = self.entries.pop(key)
+        except KeyError:
+            return
+
+        for t in tags:
+            keys = self.dependents[t]
+            keys.discard(key)
+            if not keys:
+                del self.dependents[t]
+
+    def invalidate(self, tags):
+        """Remove the results depending on any of 'tags'."""
+
+        for t in tags:
+            for key in list(self.dependents.get(t, ())):
+                self.discard(key)
+
+    def clear(self):
+        """Remove all the cached results and reset the counters."""
+
+        self.entries.clear()
+        self.dependents.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dict with the number of hits, misses and cached results."""
+
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "max_entries": self.max_entries}
+
+class DirListingCache(object):
+    """LRU cache { dirpath : [mtime, file names, subfolder names] }, refreshed when the folder mtime changes."""
+
+    # listings taken less than RACY_INTERVAL seconds after the folder mtime are not trusted,
+    # as the folder could be modified again without changing the mtime on coarse filesystems
+    RACY_INTERVAL = 2.0
+
+    def __init__(self, max_entries=1024):
+        """Initialize an empty cache holding at most 'max_entries' folder listings (0 disables the cache)."""
+
+        self.max_entries = max_entries
+
+        # dirpath -> [mtime, tuple of names, tuple of subfolder names or None until needed], least recently used first
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_entry(self, dirpath):
+        """Returns the up to date cache entry for dirpath. Raises OSError if the folder can't be listed."""
+
+        mtime = os.stat(dirpath).st_mtime
+
+        entry = self.entries.pop(dirpath, None)
+        if entry is not None and entry[0] == mtime:
+            self.entries[dirpath] = entry
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = [mtime, tuple(os.listdir(dirpath)), None]
+
+        if self.max_entries > 0 and time.time() - mtime >= self.RACY_INTERVAL:
+            self.entries[dirpath] = entry
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        return entry
+
+    def listdir(self, dirpath):
+        """Returns the names inside dirpath, as os.listdir. Raises OSError if the folder can't be listed."""
+
+        return self.get_entry(dirpath)[1]
+
+    def listfiles(self, dirpath):
+        """Returns the names of the files inside dirpath, without its subfolders. Raises OSError if the folder can't be listed."""
+
+        entry = self.get_entry(dirpath)
+        subdir_set = set(self.get_subdirs(dirpath, entry))
+
+        return [n for n in entry[1] if n not in subdir_set]
+
+    def get_subdirs(self, dirpath, entry):
+        """Returns the subfolder names of the cache entry for dirpath, only checking the content of the folder the first time."""
+
+        if entry[2] is None:
+            entry[2] = tuple(n for n in entry[1] if os.path.isdir(os.path.join(dirpath, n)))
+
+        return entry[2]
+
+    def walk(self, dirpath, onerror=None):
+        """Yield (dirpath, subfolder names, file names) for dirpath and all the folders inside it, as os.walk.
+        The subfolder names list can be modified in place to skip some of them."""
+
+        try:
+            entry = self.get_entry(dirpath)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            return
+
+        subdirs = list(self.get_subdirs(dirpath, entry))
+        subdir_set = set(subdirs)
+        fnames = [n for n in entry[1] if n not in subdir_set]
+
+        yield dirpath, subdirs, fnames
+
+        for subdir in subdirs:
+            for result in self.walk(os.path.join(dirpath, subdir), onerror):
+                yield result
+
+    def discard(self, dirpath):
+        """Remove the listing cached for dirpath, if any."""
+
+        self.entries.pop(dirpath, None)
+
+    def clear(self):
+        """Remove all the cached listings and reset the counters."""
+
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns a dict with the number of hits, misses and cached listings."""
+
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "max_entries": self.max_entries}
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    query_cache = QueryCache(max_entries=2)
+
+    text_key = query_cache.make_key(utils.FILTERMODE.ALL, "text", "important")
+    photo_key = query_cache.make_key(utils.FILTERMODE.ANY, "photo")
+
+    query_cache.put(text_key, [r'C:\test_mdata_file.txt'], ["text", "important"])
+    query_cache.put(photo_key, [r'C:\photo.jpg'], ["photo"])
+
+    # tags order doesn't matter
+    print query_cache.get(query_cache.make_key(utils.FILTERMODE.ALL, "important", "text"))
+
+    # only the results depending on "photo" are dropped
+    query_cache.invalidate(["photo"])
+    print query_cache.get(photo_key), query_cache.get(text_key)
+
+    print query_cache.stats()
+
+    import tempfile
+
+    # listings are reused until the folder is modified
+    listing_cache = DirListingCache()
+    dirpath = tempfile.mkdtemp()
+    open(os.path.join(dirpath, "first_file.txt"), "w").close()
+    # pretend the folder was modified a while ago, so that the listing can be trusted
+    os.utime(dirpath, (time.time() - 60, time.time() - 60))
+
+    print listing_cache.listdir(dirpath), listing_cache.listdir(dirpath)
+
+    open(os.path.join(dirpath, "second_file.txt"), "w").close()
+    print sorted(listing_cache.listdir(dirpath))
+
+    # folders can also be walked recursively
+    os.mkdir(os.path.join(dirpath, "subfolder"))
+    open(os.path.join(dirpath, "subfolder", "nested_file.txt"), "w").close()
+    for walked_dirpath, subdirs, fnames in listing_cache.walk(dirpath):
+        print walked_dirpath, subdirs, sorted(fnames)
+
+    print listing_cache.stats()
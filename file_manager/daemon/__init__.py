@@ -0,0 +1,341 @@
+"""
+This module contains a long-lived server keeping the file_manager database loaded in memory,
+and a thin client to query it. Requests and responses are json lines exchanged over a
+Unix domain socket (or a localhost TCP socket where those are not available).
+
+Each client connection is served by its own thread, and requests run one at a time under
+REQUEST_LOCK. Over TCP, every local user can connect, so requests must carry the token the
+server writes into the token file inside DBASE_PATH, which the Client reads.
+
+e.g.
+
+# start the server from a cmd - this blocks until a client sends 'shutdown'
+python -m file_manager --serve
+
+# query it from a script
+import daemon
+
+client = daemon.Client()
+client.tag(r'C:\test_mdata_file.txt', utils.TAGMODE.ADD, "text", "important")
+print client.filter(utils.FILTERMODE.ANY, "important")
+client.save()
+client.close()
+
+Classes:
+    Client
+    RequestHandler
+    ThreadingTCPServer
+    ThreadingUnixStreamServer
+
+Variables:
+    REQUEST_LOCK
+"""
+
+import hmac
+import json
+import logging as log
+import os
+import socket
+import SocketServer
+import threading
+
+try:
+    import f_manager
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve f_manager and utils modules
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import f_manager
+    import utils
+
+# address used on platforms without Unix domain sockets
+TCP_ADDRESS = ("127.0.0.1", 50507)
+# seconds between the checks for shutdown and for a due journal sync, while no new client connects
+POLL_INTERVAL = 1.0
+
+# held while running a request, as the f_manager module is not thread-safe
+REQUEST_LOCK = threading.Lock()
+
+def get_default_address():
+    """Returns the default address for the server: a socket file inside DBASE_PATH, or TCP_ADDRESS."""
+
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(f_manager.DBASE_PATH, "file_manager.sock")
+
+    return TCP_ADDRESS
+
+def get_token_path():
+    """Returns the path of the file holding the token required by a TCP server, inside DBASE_PATH."""
+
+    return os.path.join(f_manager.DBASE_PATH, "file_manager.token")
+
+def create_token():
+    """Generate a new random token and write it into the token file, readable by the current user only.
+    Returns the token."""
+
+    token = os.urandom(16).encode("hex")
+    token_path = get_token_path()
+
+    if os.path.exists(token_path):
+        os.remove(token_path)
+
+    token_file = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    try:
+        os.write(token_file, token)
+    finally:
+        os.close(token_file)
+
+    return token
+
+def read_token():
+    """Returns the token written by the running TCP server, or None if it can't be read."""
+
+    try:
+        with open(get_token_path(), "r") as token_file:
+            return token_file.read().strip()
+    except IOError as e:
+        log.error("Unable to read the file_manager server token because {}".format(e))
+        return None
+
+def save():
+    """Save the database, returning the SaveReport as a dict."""
+
+    result = f_manager.save()
+    return dict(f_manager.last_save_report._asdict(), result=result)
+
+# { command : function } served to the clients; requests args are passed positionally
+COMMANDS = {
+    "tag": f_manager.tag,
+    "filter": f_manager.get_files_for_tags,
+    "query": f_manager.get_files_for_query,
+    "explain": f_manager.explain_query,
+    "list_mdata": f_manager.list_mdata,
+    "save": save,
+    "ping": lambda: "pong",
+}
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Handles json line requests { "command" : name, "args" : [...], "token" : token } for a single client connection.
+    The token is only checked if the server has one."""
+
+    def handle(self):
+        """Answer each request line with a { "result" : value } or { "error" : message } json line.
+        Runs in its own thread until the client disconnects."""
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                request = utils.json_loads(line)
+                command = request["command"]
+                args = request.get("args", [])
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self.respond({"error": "Invalid request {} - {}".format(line.strip(), e)})
+                continue
+
+            if self.server.token is not None and not hmac.compare_digest(str(request.get("token", "")), self.server.token):
+                self.respond({"error": "Invalid token, see {}".format(get_token_path())})
+                break
+
+            if command == "shutdown":
+                self.server.stopping = True
+                self.respond({"result": True})
+                break
+
+            try:
+                function = COMMANDS[command]
+            except KeyError:
+                self.respond({"error": "Unknown command '{}'. Available commands: {}".format(command, sorted(COMMANDS.keys()))})
+                continue
+
+            try:
+                with REQUEST_LOCK:
+                    result = function(*args)
+            except Exception as e: # pylint: disable=W0703
+                # keep the server alive whatever happens while serving a request
+                log.error("Request {} failed - {}".format(request, e))
+                self.respond({"error": "{}: {}".format(type(e).__name__, e)})
+                continue
+
+            self.respond({"result": result})
+
+    def respond(self, response):
+        """Write a json line response to the client."""
+
+        self.wfile.write(json.dumps(response, cls=utils.Encoder) + "\n")
+        self.wfile.flush()
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """TCP server handling each connection in a thread, so that an idle client doesn't block the others."""
+
+    # open connections don't keep the process alive once the server stops
+    daemon_threads = True
+    # a restarted server can bind the address while the previous connections are closing
+    allow_reuse_address = True
+
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Unix domain socket server handling each connection in a thread, see ThreadingTCPServer."""
+
+    daemon_threads = True
+
+def serve(address=None, lazy=None):
+    """Load the database and serve requests on 'address' until a client sends 'shutdown'.
+    Changes are saved before returning."""
+
+    address = address or get_default_address()
+
+    f_manager.init(lazy=lazy)
+
+    if isinstance(address, tuple):
+        server = ThreadingTCPServer(address, RequestHandler)
+        # any local user can connect, only the ones able to read the token file are served
+        server.token = create_token()
+    else:
+        # remove the socket file left behind by a previous server
+        if os.path.exists(address):
+            os.remove(address)
+
+        server = ThreadingUnixStreamServer(address, RequestHandler)
+        # the database content is only meant for the current user
+        os.chmod(address, 0600)
+        server.token = None
+
+    server.stopping = False
+    # handle_request returns after this many seconds without new connections
+    server.timeout = POLL_INTERVAL
+    log.info("file_manager server listening on {}".format(address))
+
+    try:
+        while not server.stopping:
+            server.handle_request()
+
+            # the journal only checks the age of its entries when new ones are appended
+            with REQUEST_LOCK:
+                f_manager.sync_journal()
+    finally:
+        server.server_close()
+        if isinstance(address, tuple):
+            os.remove(get_token_path())
+        elif os.path.exists(address):
+            os.remove(address)
+
+        with REQUEST_LOCK:
+            f_manager.save()
+            f_manager.close()
+
+class Client(object):
+    """Thin client for the file_manager server. Methods mirror the f_manager functions."""
+
+    def __init__(self, address=None, timeout=None, token=None):
+        """Connect to the server listening on 'address' (the default server address if not provided).
+        The token of a TCP server is read from its token file if not provided."""
+
+        self.address = address or get_default_address()
+        self.token = None
+
+        if isinstance(self.address, tuple):
+            self.token = token or read_token()
+            self.connection = socket.create_connection(self.address, timeout)
+        else:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.settimeout(timeout)
+            self.connection.connect(self.address)
+
+        self.connection_file = self.connection.makefile("rb")
+
+    def call(self, command, *args):
+        """Send a request to the server and return its result, or None if the request failed."""
+
+        request = {"command": command, "args": args}
+        if self.token is not None:
+            request["token"] = self.token
+
+        self.connection.sendall(json.dumps(request, cls=utils.Encoder) + "\n")
+
+        line = self.connection_file.readline()
+        if not line:
+            log.error("Connection to the file_manager server at {} was closed".format(self.address))
+            return None
+
+        response = utils.json_loads(line)
+        if "error" in response:
+            log.error("file_manager server error - {}".format(response["error"]))
+            return None
+
+        return response["result"]
+
+    def tag(self, fpath, mode, *tags):
+        """Modify tags for the provided fpath."""
+
+        return self.call("tag", os.path.abspath(fpath), mode, *tags)
+
+    def filter(self, mode, *tags):
+        """Get a list of paths that match the given tags with the provided mode."""
+
+        return self.call("filter", mode, *tags)
+
+    def query(self, expression):
+        """Get a list of paths that match the boolean query 'expression'."""
+
+        return self.call("query", expression)
+
+    def explain(self, expression):
+        """Returns a description of the execution plans for the boolean query 'expression'."""
+
+        return self.call("explain", expression)
+
+    def list_mdata(self, folder_path=None):
+        """Returns a list of tagged files for the provided 'folder_path' (or all of them if None)."""
+
+        return self.call("list_mdata", folder_path)
+
+    def save(self):
+        """Save the database, returning a dict with the number of records written and the elapsed time."""
+
+        return self.call("save")
+
+    def shutdown(self):
+        """Stop the server, saving the database."""
+
+        result = self.call("shutdown")
+        self.close()
+        return result
+
+    def close(self):
+        """Close the connection to the server."""
+
+        self.connection_file.close()
+        self.connection.close()
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    import tempfile
+    import threading
+    import time
+
+    # example file to tag
+    fpath = os.path.join(tempfile.mkdtemp(), "test_mdata_file.txt")
+    open(fpath, "w").close()
+
+    # start a server in the background
+    address = os.path.join(tempfile.mkdtemp(), "file_manager.sock") if hasattr(socket, "AF_UNIX") else TCP_ADDRESS
+    server_thread = threading.Thread(target=serve, args=(address,))
+    server_thread.start()
+
+    while not os.path.exists(get_token_path() if isinstance(address, tuple) else address):
+        time.sleep(0.1)
+
+    # query it
+    client = Client(address)
+    client.tag(fpath, utils.TAGMODE.ADD, "text", "important")
+    print client.filter(utils.FILTERMODE.ANY, "important")
+    print client.list_mdata(os.path.dirname(fpath))
+
+    # stop it, saving the changes
+    client.shutdown()
+    server_thread.join()
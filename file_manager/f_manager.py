@@ -16,35 +16,276 @@ fs.save()
 """
 
 import argparse
+import glob
+import heapq
+import itertools
 import os
 import logging as log
 import json
+import multiprocessing
+import stat
 import sys
+import time
 import uuid
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
+import cache
+import index
+import journal
 import mdata
+import query
 import utils
 import security
+import store
 
-DBaseEntry = namedtuple("DBaseEntry", ["descriptor", "mdata_list", "dir_mdata"])
 DirDescriptor = namedtuple("DirDescriptor", ["dirpath", "dir_uuid"])
+SaveReport = namedtuple("SaveReport", ["records", "elapsed"])
+BulkTagReport = namedtuple("BulkTagReport", ["files", "folders", "errors", "elapsed"])
 
 DBASE_PATH = r'C:\Program Files\FileManager'
 dbase_path = os.path.join(DBASE_PATH, "file_manager.dbase")
 config_path = os.path.join(DBASE_PATH, "file_manager.dbconfig")
 dir_mdata_path = os.path.join(DBASE_PATH, "dir_mdata")
+store_path = os.path.join(DBASE_PATH, "file_manager.sqlite")
+journal_path = os.path.join(DBASE_PATH, "file_manager.journal")
 
 # folder_dbase is a dict { dirpath : DBaseEntry } to allow bosth storage of
 # the mdata_list and of a DirDescriptor for serialization
 folder_dbase = {}
 config = {}
 
-def init(hid=None):
-    """Load the folder database and the config file."""
+# { fpath : MData } for the files of all the folders currently loaded
+file_records = {}
+
+# the .dbase and config files are only rewritten when modified
+dbase_dirty = False
+config_dirty = False
+# SaveReport for the last call to save()
+last_save_report = None
+# BulkTagReport for the last call to bulk_tag()
+last_bulk_report = None
+
+# every tag modification is logged into the journal until the next save(), which happens
+# automatically once the journal holds journal_compact_size entries
+tag_journal = None
+journal_sync_every = 64
+journal_compact_size = 10000
+
+# the SQLiteStore holding all the metadata records, or None if they are stored as .mdata files
+record_store = None
+
+# inverted indexes { tag : set(paths) } for file and folder metadata, kept in sync by MData
+file_index = index.TagIndex()
+dir_index = index.TagIndex()
+
+# LRU cache of the filter results { (mode, sorted tags) : (matching dirs, matching files) },
+# a result is dropped as soon as one of its tags is modified in either index
+query_cache = cache.QueryCache(max_entries=128)
+
+# when recursive_tags is enabled, folders inherit the tags of their ancestors: the effective
+# tags of the tagged folders are kept up to date by inherited_index as dir_index changes
+recursive_tags = False
+inherited_index = index.InheritedTagIndex()
+
+def on_file_index_change(fpath, tags):
+    """Drop the cached results depending on the modified tags."""
+
+    query_cache.invalidate(tags)
+
+def on_dir_index_change(dirpath, tags):
+    """Drop the cached results depending on the modified tags and update the effective tags of dirpath and its descendants."""
+
+    query_cache.invalidate(tags)
+    inherited_index.set_tags(dirpath, dir_index.get_tags(dirpath))
+
+file_index.add_listener(on_file_index_change)
+dir_index.add_listener(on_dir_index_change)
+
+# folders matched by a query are expanded into their files from this cache, instead of listing them each time
+listing_cache = cache.DirListingCache(max_entries=1024)
+
+# { sort key : stat attribute (None to sort by name) } accepted by iter_sorted_paths
+SORT_KEYS = {"mtime": "modified", "ctime": "created", "size": "size", "name": None}
+
+# False while some folders in the database were never loaded, and are thus unknown by the indexes
+dbase_indexed = True
+
+# when the database is loaded, folder records are read by load_threads threads and decoded
+# by load_processes processes (0 to decode them in the main process)
+load_threads = 4
+load_processes = 0
+
+# when lazy_load is enabled, folder metadata is loaded on first access and at most
+# max_loaded_folders folders are kept in memory, least recently used ones are released first
+lazy_load = False
+max_loaded_folders = 256
+loaded_entries = OrderedDict()
+
+class DBaseEntry(object):
+    """Entry of the folder_dbase: holds the DirDescriptor of a folder and materializes its metadata on access."""
+
+    def __init__(self, descriptor, mdata_list=None, dir_mdata=None):
+        """Initialize the entry. Metadata not provided is loaded from disk on first access."""
+
+        self.descriptor = descriptor
+        self.is_dirty = False
+        # True once the folder metadata has been loaded at least once, and is thus known by the indexes
+        self.is_indexed = mdata_list is not None and dir_mdata is not None
+
+        self._mdata_list = None
+        # { file name : MData } for the files in this folder
+        self._mdata_map = None
+        self._dir_mdata = dir_mdata
+
+        if mdata_list is not None:
+            self.set_mdata_list(mdata_list)
+
+    @property
+    def is_loaded(self):
+        """Returns True if the folder metadata is currently held in memory."""
+
+        return self._mdata_list is not None or self._dir_mdata is not None
+
+    @property
+    def mdata_list(self):
+        """Returns the list of MData for the files in this folder, loading it if needed."""
+
+        if self._mdata_list is None:
+            self.set_mdata_list(load_folder_mdatas(self.descriptor.dirpath))
+            self.is_indexed = self.is_indexed or self._dir_mdata is not None
+
+        touch_dbase_entry(self)
+        return self._mdata_list
+
+    @property
+    def mdata_map(self):
+        """Returns the dict { file name : MData } for the files in this folder, loading it if needed."""
+
+        self.mdata_list
+        return self._mdata_map
+
+    def set_mdata_list(self, mdata_list):
+        """Set the loaded list of MData for the files in this folder, and register them by name and path."""
+
+        self._mdata_list = mdata_list
+        self._mdata_map = dict((md.fname, md) for md in mdata_list)
+        file_records.update((md.fpath, md) for md in mdata_list)
+
+    def add_mdata(self, mdata_file):
+        """Add the MData of a new file in this folder."""
+
+        self.mdata_list.append(mdata_file)
+        self._mdata_map[mdata_file.fname] = mdata_file
+        file_records[mdata_file.fpath] = mdata_file
+
+    def get_mdata(self, fname):
+        """Returns the MData for the file named fname (with extension) in this folder, or None."""
+
+        return self.mdata_map.get(fname)
+
+    @property
+    def dir_mdata(self):
+        """Returns the MData for this folder, loading it if needed."""
+
+        if self._dir_mdata is None:
+            self._dir_mdata = load_dir_mdata(self.descriptor)
+            self.is_indexed = self.is_indexed or self._mdata_list is not None
+
+        touch_dbase_entry(self)
+        return self._dir_mdata
+
+    def load(self):
+        """Load all the metadata for this folder, adding it to the indexes."""
+
+        self.dir_mdata
+        self.mdata_list
+        self.is_indexed = True
+
+    def set_loaded(self, dir_mdata, mdata_list):
+        """Set the metadata for this folder, loaded by load_dbase_entries. Metadata already in memory is kept,
+        as it may hold changes that aren't saved yet."""
+
+        if self._dir_mdata is None:
+            self._dir_mdata = dir_mdata
+        if self._mdata_list is None:
+            self.set_mdata_list(mdata_list)
+        self.is_indexed = True
+
+        touch_dbase_entry(self)
+
+    def save(self, force=False):
+        """Save the modified metadata for this folder to disk, or all the loaded metadata if 'force' is True.
+        Returns the number of records written."""
+
+        if not (self.is_dirty or force):
+            return 0
+
+        result = True
+        records = 0
+
+        for mdata_file in ([self._dir_mdata] if self._dir_mdata else []) + (self._mdata_list or []):
+            if not (mdata_file.is_dirty or force):
+                continue
+
+            if mdata_file.save():
+                records += 1
+            else:
+                result = False
+
+        if result:
+            self.is_dirty = False
+
+        return records
+
+    def refresh_stats(self, force=False):
+        """Capture the stat data of the files in this folder, for the records whose data is stale (or all of them
+        if 'force' is True). Returns the number of refreshed records."""
+
+        stale = [md for md in self.mdata_list if force or md.is_stat_stale]
+        if not stale:
+            return 0
+
+        try:
+            stats = dict(utils.iter_dir_stats(self.descriptor.dirpath, [md.fname for md in stale]))
+        except OSError as e:
+            log.error("Unable to list files for folder <{}> because {}".format(self.descriptor.dirpath, e))
+            stats = {}
+
+        for md in stale:
+            # files missing from the scan are stat'ed again, to be marked as missing
+            md.get_common_mdata(stats.get(md.fname))
+
+        return len(stale)
+
+    def unload(self):
+        """Release the metadata for this folder, saving it first if modified. The indexes are left untouched."""
+
+        if self.is_dirty:
+            self.save()
+
+        self.release()
+
+    def release(self):
+        """Drop the metadata for this folder from memory, without saving it. The indexes are left untouched."""
+
+        for md in self._mdata_list or []:
+            file_records.pop(md.fpath, None)
+
+        self._mdata_list = None
+        self._mdata_map = None
+        self._dir_mdata = None
+
+def init(hid=None, lazy=None):
+    """Load the folder database and the config file. If 'lazy' is provided, it overrides the loading mode from the config."""
 
     global config_path
     global dbase_path
+    global lazy_load
+    global max_loaded_folders
+    global recursive_tags
+    global load_threads
+    global load_processes
 
     utils.make_dirs_if_not_existent(DBASE_PATH)
 
@@ -57,7 +298,7 @@ def init(hid=None):
                 config_file_data = config_file.read()
 
                 if hid:
-                    config_file_data = security.xor_string(config_file_data, security.generate_base_key(1024, hid))
+                    config_file_data = security.xor_string(config_file_data, security.derive_key(hid))
                 else:
                     config_file_data = security.xor_hid(config_file_data)
 
@@ -65,6 +306,22 @@ def init(hid=None):
             except IOError:
                 pass
 
+    lazy_load = config.get("lazy_load", False) if lazy is None else lazy
+    max_loaded_folders = config.get("max_loaded_folders", max_loaded_folders)
+    load_threads = config.get("load_threads", load_threads)
+    load_processes = config.get("load_processes", load_processes)
+
+    query_cache.clear()
+    query_cache.max_entries = config.get("query_cache_size", query_cache.max_entries)
+    listing_cache.clear()
+    listing_cache.max_entries = config.get("listing_cache_size", listing_cache.max_entries)
+
+    recursive_tags = config.get("recursive_tags", False)
+
+    mdata.set_stat_max_age(config.get("stat_max_age", None))
+
+    set_record_store(open_store(config.get("storage", utils.STORAGE.FILES)))
+
     if os.path.exists(dbase_path):
         with open(dbase_path, "r") as dbase_file:
             try:
@@ -72,36 +329,96 @@ def init(hid=None):
             except IOError:
                 pass
 
+    open_journal()
+
+def open_journal():
+    """Open the tag journal and re-apply the modifications logged since the last save."""
+
+    global journal_path
+    global tag_journal
+    global journal_sync_every
+    global journal_compact_size
+
+    if tag_journal is not None:
+        tag_journal.close()
+
+    journal_sync_every = config.get("journal_sync_every", journal_sync_every)
+    journal_compact_size = config.get("journal_compact_size", journal_compact_size)
+
+    tag_journal = journal.Journal(journal_path, security.xor_key, sync_every=journal_sync_every)
+
+    for mode, fpath, tags in tag_journal.replay():
+        tag(fpath, mode, *tags, log_to_journal=False)
+
 def save():
-    """Save the database to disk."""
+    """Save the modified parts of the database to disk."""
 
     global dbase_path
     global config_path
+    global dbase_dirty
+    global config_dirty
+    global last_save_report
+
+    start_time = time.time()
+    records = 0
 
     dbase_save_result = True
-    # write .dbase file to disk
-    with open(dbase_path, "w+") as dbase_file:
-        try:
-            dbase_file.write(serialize(utils.FMCOREFILES.DATABASE))
+    # write .dbase file to disk, only if folders were added
+    if dbase_dirty:
+        with open(dbase_path, "w+") as dbase_file:
+            try:
+                dbase_file.write(serialize(utils.FMCOREFILES.DATABASE))
+                dbase_dirty = False
+            except IOError as e:
+                log.error("Couldn't write dbase at <{}> because {}".format(dbase_path, e))
+                dbase_save_result = False
 
-            for _, db_entry in folder_dbase.items():
-                db_entry.dir_mdata.save()
+    # only the modified records are saved, the others are already up to date on disk
+    for _, db_entry in folder_dbase.items():
+        records += db_entry.save()
+        dbase_save_result = dbase_save_result and not db_entry.is_dirty
 
-        except IOError as e:
-            log.error("Couldn't write dbase at <{}> because {}".format(dbase_path, e))
-            dbase_save_result = False
+    if record_store:
+        dbase_save_result = record_store.commit() and dbase_save_result
 
     config_save_result = True
-    # write .config file to disk
-    with open(config_path, "w+") as config_file:
-        try:
-            config_file.write(security.xor_hid(serialize(utils.FMCOREFILES.CONFIG)))
-        except IOError as e:
-            log.error("Couldn't write config at <{}> because {}".format(config_path, e))
-            config_save_result = False
+    # write .config file to disk, only if modified
+    if config_dirty:
+        with open(config_path, "w+") as config_file:
+            try:
+                config_file.write(security.xor_hid(serialize(utils.FMCOREFILES.CONFIG)))
+                config_dirty = False
+            except IOError as e:
+                log.error("Couldn't write config at <{}> because {}".format(config_path, e))
+                config_save_result = False
+
+    # the logged modifications are now part of the metadata store
+    if tag_journal is not None and dbase_save_result and config_save_result:
+        tag_journal.truncate()
+
+    last_save_report = SaveReport(records=records, elapsed=time.time() - start_time)
+    log.info("Saved {} records in {:.3f}s".format(last_save_report.records, last_save_report.elapsed))
 
     return dbase_save_result and config_save_result
 
+def sync_journal(force=False):
+    """Force the journal entries to disk if their sync is due, or anyway if 'force' is True.
+    Meant to be called while waiting for the next modification."""
+
+    if tag_journal is None:
+        return True
+
+    return tag_journal.sync() if force else tag_journal.sync_if_due()
+
+def close():
+    """Sync the journal and release the metadata store. Unsaved modifications are kept in the journal."""
+
+    if tag_journal is not None:
+        tag_journal.close()
+
+    if record_store:
+        record_store.close()
+
 def serialize(fmcorefile):
     """Returns a json string representation of an object for serialization."""
 
@@ -127,46 +444,83 @@ def deserialize(data, fmcorefile):
     global dir_mdata_path
     global folder_dbase
     global config
+    global dbase_indexed
 
     try:
         if fmcorefile == utils.FMCOREFILES.DATABASE:
-            descriptor_list = utils.json_decode(json.loads(data))
+            descriptor_list = utils.json_loads(data)
+            db_entries = []
             for d_dict in descriptor_list:
                 try:
                     # generate a DirDescriptor namedtuple from the deserialized dict
                     # NOTE: the field must be in the same order as the namedtuple declaration
                     dir_desc = DirDescriptor(**d_dict)
 
-                    dir_mdata = mdata.MData(dir_desc.dirpath, autoload=False)
-                    dir_mdata.override_save_path(dir_mdata_path, dir_desc.dir_uuid)
-                    dir_mdata.load()
+                    replaced_entry = folder_dbase.get(dir_desc.dirpath)
+                    if replaced_entry is not None:
+                        # the records of the previous entry must no longer be found through file_records
+                        replaced_entry.release()
+                        loaded_entries.pop(dir_desc.dirpath, None)
 
-                    folder_dbase[dir_desc.dirpath] = DBaseEntry(descriptor=dir_desc, mdata_list=load_folder_mdatas(dir_desc.dirpath), dir_mdata=dir_mdata)
+                    folder_dbase[dir_desc.dirpath] = db_entry = DBaseEntry(descriptor=dir_desc)
+                    db_entries.append(db_entry)
                 except KeyError as ke:
                     log.error("Unable to generate database entry from descriptor {}. Exception: {}".format(d_dict, ke))
+
+            if not lazy_load:
+                load_dbase_entries(db_entries)
+            elif db_entries:
+                dbase_indexed = False
         elif fmcorefile == utils.FMCOREFILES.CONFIG:
-            config = utils.json_decode(json.loads(data))
+            config = utils.json_loads(data)
     except ValueError as v_error:
         log.error("{} deserialization failed for <{}> - {}".format(
             utils.FMCOREFILES.get_name(fmcorefile).capitalize(), dbase_path, v_error))
 
+def load_dir_mdata(dir_desc):
+    """Load the .mdata file for the folder described by dir_desc."""
+
+    global dir_mdata_path
+
+    dir_mdata = mdata.MData(dir_desc.dirpath, utils.FTYPE.DIR, autoload=False, index=dir_index)
+    dir_mdata.override_save_path(dir_mdata_path, dir_desc.dir_uuid)
+    dir_mdata.load()
+
+    return dir_mdata
+
 def load_folder_mdatas(dirpath):
     """Load all .mdata files for this dirpath."""
 
-    mdata_dirpath = os.path.join(dirpath, "_mdata")
+    if record_store:
+        # all the records for this folder are read with a single query
+        mdatas = []
+        for fpath, data in sorted(record_store.load_folder(dirpath)):
+            md = mdata.MData(fpath, autoload=False, index=file_index)
+            # decrypted by mdata, as it encrypted the record
+            md.load_record(data)
+            mdatas.append(md)
+
+        return mdatas
+
+    mdata_dirpath = mdata.MData.get_mdata_folder(dirpath)
 
     if not os.path.exists(mdata_dirpath):
         return []
 
+    # shared by the .mdata files of this folder, so that legacy files without a stored
+    # file name list dirpath at most once
+    name_maps = {}
+
     mdatas = []
-    for root, _, files in os.walk(mdata_dirpath):
-        for mdata_fname in files:
-            mdatas.append(mdata.MData(os.path.join(root, mdata_fname), utils.FTYPE.MDATA))
+    for mdata_fname in sorted(os.listdir(mdata_dirpath)):
+        md = mdata.MData(os.path.join(mdata_dirpath, mdata_fname), utils.FTYPE.MDATA, index=file_index, name_maps=name_maps)
+        if md.fpath:
+            mdatas.append(md)
 
     return mdatas
 
-def create_mdata_for_file(fpath):
-    """Create a new .mdata file."""
+def create_mdata_for_file(fpath, stat_result=None):
+    """Create a new .mdata file. 'stat_result' is the current stat of the file, if already available."""
 
     global folder_dbase
 
@@ -177,23 +531,16 @@ def create_mdata_for_file(fpath):
     # ensure directoy exists
     utils.make_dirs_if_not_existent(dirpath)
 
-    # get .mdata files for this folder 
-    try:
-        folder_mdata = folder_dbase[dirpath].mdata_list
-    except KeyError:
-        folder_mdata = []
-
-    # generate and save new .mdata file
-    mdata_file = mdata.MData(fpath)
-    mdata_file.save()
+    # generate the new .mdata, it's written to disk on save() once modified
+    mdata_file = mdata.MData(fpath, index=file_index, stat_result=stat_result)
 
     # add this .mdata to the folder database
-    folder_mdata.append(mdata_file)
-    try:
-        folder_dbase[dirpath].mdata_list = folder_mdata 
-    except KeyError:
+    if dirpath not in folder_dbase:
         generate_dbase_entry(dirpath)
 
+    folder_dbase[dirpath].add_mdata(mdata_file)
+    folder_dbase[dirpath].is_dirty = True
+
     return mdata_file
 
 def generate_dbase_entry(dirpath):
@@ -201,47 +548,316 @@ def generate_dbase_entry(dirpath):
 
     global folder_dbase
     global dir_mdata_path
+    global dbase_dirty
 
     # generate random id for this directory mdata file
     dir_mdata_uuid = uuid.uuid4()
 
     # create the mdata object for this directory
-    dir_mdata = mdata.MData(dirpath, autoload=False)
+    dir_mdata = mdata.MData(dirpath, utils.FTYPE.DIR, autoload=False, index=dir_index)
     dir_mdata.override_save_path(dir_mdata_path, dir_mdata_uuid)
     dir_mdata.load()
 
-    folder_dbase[dirpath] = DBaseEntry(descriptor=DirDescriptor(dirpath=dirpath, dir_uuid=dir_mdata_uuid), mdata_list=[], dir_mdata=dir_mdata)
+    folder_dbase[dirpath] = db_entry = DBaseEntry(descriptor=DirDescriptor(dirpath=dirpath, dir_uuid=dir_mdata_uuid), mdata_list=[], dir_mdata=dir_mdata)
+    touch_dbase_entry(db_entry)
+
+    dbase_dirty = True
+
+def touch_dbase_entry(db_entry):
+    """Mark db_entry as the most recently used and release the least recently used folders when lazy_load is enabled."""
+
+    global loaded_entries
+
+    if not lazy_load:
+        return
+
+    dirpath = db_entry.descriptor.dirpath
+
+    loaded_entries.pop(dirpath, None)
+    loaded_entries[dirpath] = db_entry
+
+    while len(loaded_entries) > max(max_loaded_folders, 1):
+        _, lru_entry = loaded_entries.popitem(last=False)
+        lru_entry.unload()
+
+def index_dbase():
+    """Ensure that every folder in the database is known by the indexes, loading the ones that were never loaded."""
+
+    global folder_dbase
+    global dbase_indexed
+
+    if dbase_indexed:
+        return
+
+    load_dbase_entries([db_entry for db_entry in folder_dbase.values() if not db_entry.is_indexed])
+
+    dbase_indexed = True
+
+def load_dbase_entries(db_entries):
+    """Load the metadata of all db_entries. The records are read by a pool of load_threads threads, and decoded
+    by a pool of load_processes processes. Folders are added to the indexes in dirpath order, whatever the order
+    the workers complete in, so that the result doesn't depend on the number of workers."""
+
+    db_entries = sorted(db_entries, key=lambda db_entry: db_entry.descriptor.dirpath)
+
+    # folders partially in memory only load the missing part, as reading them again would drop their changes
+    for db_entry in db_entries:
+        if db_entry.is_loaded:
+            db_entry.load()
+    db_entries = [db_entry for db_entry in db_entries if not db_entry.is_indexed]
+
+    if len(db_entries) < 2 or (load_threads <= 1 and load_processes <= 0):
+        for db_entry in db_entries:
+            db_entry.load()
+        return
+
+    # the sqlite connection can't be shared between threads
+    if record_store or load_threads <= 1:
+        folder_records = [read_folder_records(db_entry) for db_entry in db_entries]
+    else:
+        thread_pool = ThreadPool(min(load_threads, len(db_entries)))
+        try:
+            folder_records = thread_pool.map(read_folder_records, db_entries)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    # the key is passed to the workers, as they don't share the config with this process. It's taken from
+    # the security module mdata encrypts the records with, as it's a separate copy when run as a package
+    key = mdata.security.get_key()
+    tasks = [(key, [record for _, record in records]) for records in folder_records]
+
+    if load_processes > 0:
+        process_pool = multiprocessing.Pool(load_processes)
+        try:
+            folder_data = process_pool.map(mdata.decode_records, tasks, chunksize=max(len(tasks) // (load_processes * 4), 1))
+        finally:
+            process_pool.close()
+            process_pool.join()
+    else:
+        folder_data = [mdata.decode_records(task) for task in tasks]
+
+    for db_entry, records, data in zip(db_entries, folder_records, folder_data):
+        db_entry.set_loaded(*build_folder_mdatas(db_entry.descriptor, records, data))
+
+def read_folder_records(db_entry):
+    """Returns the list of (path, encrypted record) for the folder of db_entry: the folder record first, then
+    the records of the files sorted by path. The record is None if it doesn't exist."""
+
+    dirpath = db_entry.descriptor.dirpath
+
+    if record_store:
+        return [(dirpath, record_store.load_record(dirpath))] + sorted(record_store.load_folder(dirpath))
+
+    dir_record_path = os.path.join(dir_mdata_path, "{}.mdata".format(db_entry.descriptor.dir_uuid))
+    records = [(dir_record_path, read_record_file(dir_record_path))]
+
+    mdata_dirpath = mdata.MData.get_mdata_folder(dirpath)
+    if os.path.exists(mdata_dirpath):
+        for mdata_fname in sorted(os.listdir(mdata_dirpath)):
+            mdata_path = os.path.join(mdata_dirpath, mdata_fname)
+            records.append((mdata_path, read_record_file(mdata_path)))
+
+    return records
+
+def read_record_file(mdata_path):
+    """Returns the content of the .mdata file at mdata_path, or None if it can't be read."""
+
+    if not os.path.exists(mdata_path):
+        return None
+
+    try:
+        with open(mdata_path, "r") as mdata_file:
+            return mdata_file.read()
+    except IOError as e:
+        log.error("Couldn't read metadata at <{}> because {}".format(mdata_path, e))
+        return None
+
+def build_folder_mdatas(dir_desc, records, data):
+    """Returns the (dir MData, list of file MData) for the folder described by dir_desc, from the records read
+    by read_folder_records and their decoded data."""
+
+    dir_mdata = mdata.MData(dir_desc.dirpath, utils.FTYPE.DIR, autoload=False, index=dir_index, data=data[0])
+    dir_mdata.override_save_path(dir_mdata_path, dir_desc.dir_uuid)
+
+    # shared by the .mdata files of this folder, so that legacy files without a stored
+    # file name list dirpath at most once
+    name_maps = {}
+
+    mdatas = []
+    for (path, record), record_data in zip(records[1:], data[1:]):
+        if record_data is None:
+            log.error("Unable to load metadata record <{}>".format(path))
+            continue
+
+        if record_store:
+            md = mdata.MData(path, autoload=False, index=file_index, data=record_data)
+        else:
+            md = mdata.MData(path, utils.FTYPE.MDATA, index=file_index, name_maps=name_maps, data=record_data)
+
+        if md.fpath:
+            mdatas.append(md)
+
+    return dir_mdata, mdatas
+
+def set_lazy_load(enabled, max_folders=None):
+    """Enable or disable lazy loading of the folder metadata. The setting is stored in the config."""
+
+    global lazy_load
+    global max_loaded_folders
+    global config_dirty
+
+    lazy_load = enabled
+    config["lazy_load"] = enabled
+    config_dirty = True
+
+    if max_folders is not None:
+        max_loaded_folders = max_folders
+        config["max_loaded_folders"] = max_folders
+
+    if not lazy_load:
+        # every folder stays in memory from now on
+        loaded_entries.clear()
+
+def set_stat_max_age(max_age):
+    """Set the age in seconds after which the stat data of a file is refreshed on access (None to only refresh it
+    on demand, see refresh_stats). The setting is stored in the config."""
+
+    global config_dirty
+
+    mdata.set_stat_max_age(max_age)
+    config["stat_max_age"] = max_age
+    config_dirty = True
+
+def refresh_stats(folder_path=None, force=False):
+    """Refresh the stale stat data of the files inside folder_path (or of all the folders if None) with a single
+    scan per folder, or all the stat data if 'force' is True. Returns the number of refreshed records."""
+
+    global folder_dbase
+
+    if folder_path is not None:
+        folder_path = os.path.abspath(folder_path)
+        if folder_path not in folder_dbase:
+            log.error("No metadata for folder <{}>".format(folder_path))
+            return 0
+
+        return folder_dbase[folder_path].refresh_stats(force)
+
+    # folders not loaded capture their stat data once loaded
+    return sum(db_entry.refresh_stats(force) for db_entry in folder_dbase.values() if db_entry.is_loaded)
+
+def index_file_stats():
+    """Capture the stat values missing from the range indexes of file_index.
+    Stale values of the loaded records are refreshed first if stat_max_age is set."""
+
+    global file_index
+
+    if mdata.STAT_MAX_AGE is not None:
+        refresh_stats()
+
+    missing = set()
+    for attribute in mdata.STAT_ATTRIBUTES:
+        missing.update(file_index.get_unset_attribute(attribute))
+
+    folders = {}
+    for fpath in missing:
+        folders.setdefault(os.path.dirname(fpath), []).append(fpath)
+
+    for dirpath, fpaths in folders.iteritems():
+        try:
+            stats = dict(utils.iter_dir_stats(dirpath, [os.path.basename(fpath) for fpath in fpaths]))
+        except OSError:
+            stats = {}
+
+        for fpath in fpaths:
+            set_file_stat(fpath, stats.get(os.path.basename(fpath)))
+
+def set_file_stat(fpath, stat_result):
+    """Store the stat result of the indexed file fpath (None if it doesn't exist) into its record and the range indexes of file_index."""
+
+    global file_index
+
+    mdata_file = file_records.get(fpath)
+    if mdata_file is not None:
+        # the record updates the indexes itself
+        mdata_file.get_common_mdata(stat_result)
+    else:
+        values = mdata.get_stat_values(stat_result) if stat_result is not None else (None, None, None)
+        file_index.set_attributes(fpath, zip(mdata.STAT_ATTRIBUTES, values))
+
+def set_load_workers(threads, processes=None):
+    """Set the number of threads reading the folder records and of processes decoding them when the database is loaded.
+    The setting is stored in the config."""
+
+    global load_threads
+    global load_processes
+    global config_dirty
+
+    load_threads = threads
+    config["load_threads"] = threads
+
+    if processes is not None:
+        load_processes = processes
+        config["load_processes"] = processes
+
+    config_dirty = True
+
+def set_recursive_tags(enabled):
+    """Enable or disable the inheritance of folder tags by all their subfolders. The setting is stored in the config."""
+
+    global recursive_tags
+    global config_dirty
+
+    recursive_tags = enabled
+    config["recursive_tags"] = enabled
+    config_dirty = True
+
+    # cached results were computed with the other setting
+    query_cache.clear()
+
+def get_dir_index():
+    """Returns the TagIndex used to match folders: the effective tags of folders if recursive_tags is enabled, else their own tags."""
+
+    return inherited_index.effective if recursive_tags else dir_index
 
 def get_mdata_for_file(fpath):
     """Retrieve a MData class associated with fpath."""
 
-    global folder_dbase
+    try:
+        stat_result = os.stat(fpath)
+    except OSError:
+        stat_result = None
 
     # if the provided path is not a file, return
-    if not os.path.isfile(fpath):
+    if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
         log.error("Can't add metadata to a non-existing file")
         return
 
-    # get directory path
-    fpath = os.path.abspath(fpath)
-    if os.path.isfile(fpath):
-        dirpath = os.path.dirname(fpath)
-    else:
-        dirpath = fpath
+    return find_mdata_for_file(os.path.abspath(fpath), stat_result)
 
-    try:
-        # get list of mdata for current folder
-        folder_mdata = folder_dbase[dirpath].mdata_list
-        # get the file name for faster filtering
-        fname = os.path.basename(fpath).rpartition(".")[0]
+def find_mdata_for_file(fpath, stat_result=None):
+    """Retrieve a MData class associated with the absolute path of an existing file, creating it if needed.
+    If provided, 'stat_result' is the current stat of the file, reused as the record stat data."""
+
+    global folder_dbase
+
+    # return metadata if already loaded
+    mdata_file = file_records.get(fpath)
+
+    if mdata_file is None:
         try:
-            # return metadata if already cached, else create new MData
-            return [md for md in folder_mdata if md.is_file_mdata(fname)][0]
-        except IndexError:
-            #log.error("Unable to retrieve .mdata for file at <{}>".format(fpath))
-            return create_mdata_for_file(fpath)
-    except KeyError:
-        return create_mdata_for_file(fpath)
+            # loading the folder metadata registers it into file_records as well
+            mdata_file = folder_dbase[os.path.dirname(fpath)].get_mdata(os.path.basename(fpath))
+        except KeyError:
+            pass
+
+    if mdata_file is None:
+        return create_mdata_for_file(fpath, stat_result)
+
+    if stat_result is not None:
+        mdata_file.get_common_mdata(stat_result)
+
+    return mdata_file
 
 def list_mdata(folder_path):
     """Returns a list of tagged files for the provided 'folder_path'"""
@@ -261,44 +877,472 @@ def list_mdata(folder_path):
     else:
         return [md.fpath for db_entry in folder_dbase.values() for md in db_entry.mdata_list]
 
-def tag(fpath, mode, *tags):
-    """Modify tags for the provided fpath."""
+def tag(fpath, mode, *tags, **kwargs):
+    """Modify tags for the provided fpath. The modification is logged to the journal unless log_to_journal=False is passed."""
+
+    log_to_journal = kwargs.get("log_to_journal", True)
     
     if os.path.isfile(fpath):
-        mdata_file = get_mdata_for_file(fpath)
-
-        if mdata_file:
-            mdata_file.tag(mode, *tags)
+        is_dir = False
     elif os.path.isdir(fpath):
-        if not fpath in folder_dbase.keys():
+        is_dir = True
+    else:
+        log.error("Can't modify tags for a non-existing path <{}>".format(fpath))
+        return
+
+    fpath = os.path.abspath(fpath)
+    if not tag_path(fpath, is_dir, mode, *tags):
+        return
+
+    if log_to_journal and tag_journal is not None:
+        tag_journal.append(mode, fpath, tags)
+
+        # compact the journal into the metadata store
+        if len(tag_journal) >= journal_compact_size:
+            save()
+
+def tag_path(fpath, is_dir, mode, *tags):
+    """Modify tags for the absolute path of an existing folder (if is_dir is True) or file. Returns True on success."""
+
+    if not is_dir:
+        mdata_file = find_mdata_for_file(fpath)
+        if not mdata_file:
+            return False
+
+        mdata_file.tag(mode, *tags)
+        folder_dbase[os.path.dirname(fpath)].is_dirty = True
+    else:
+        if fpath not in folder_dbase:
             generate_dbase_entry(fpath)
 
         folder_dbase[fpath].dir_mdata.tag(mode, *tags)
+        folder_dbase[fpath].is_dirty = True
+
+    return True
+
+def bulk_tag(patterns, mode, *tags, **kwargs):
+    """Modify tags for all the paths matching 'patterns', a list of paths or glob patterns.
+    If recursive=True is passed, folders are replaced by all the files they contain, at any depth.
+    The modifications are logged to the journal with a single write. Returns a BulkTagReport."""
+
+    global last_bulk_report
+
+    start_time = time.time()
+    tagged_paths = []
+    files = folders = errors = 0
+
+    for fpath, is_dir in iter_tag_targets(patterns, kwargs.get("recursive", False)):
+        if is_dir is None or not tag_path(fpath, is_dir, mode, *tags):
+            errors += 1
+            continue
+
+        tagged_paths.append(fpath)
+        if is_dir:
+            folders += 1
+        else:
+            files += 1
+
+    if tag_journal is not None and tagged_paths:
+        tag_journal.extend(mode, tagged_paths, tags)
+
+        # compact the journal into the metadata store
+        if len(tag_journal) >= journal_compact_size:
+            save()
+
+    last_bulk_report = BulkTagReport(files=files, folders=folders, errors=errors, elapsed=time.time() - start_time)
+    log.info("Tagged {} files and {} folders in {:.3f}s".format(files, folders, last_bulk_report.elapsed))
+
+    return last_bulk_report
+
+def iter_tag_targets(patterns, recursive=False):
+    """Yield (path, is_dir) for the absolute paths matching 'patterns', a list of paths or glob patterns.
+    If 'recursive' is True, folders are replaced by the files they contain, at any depth.
+    is_dir is None for the paths that don't exist."""
+
+    for pattern in patterns:
+        fpaths = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        if not fpaths:
+            log.error("No path matching <{}>".format(pattern))
+
+        for fpath in fpaths:
+            fpath = os.path.abspath(fpath)
+
+            try:
+                is_dir = stat.S_ISDIR(os.stat(fpath).st_mode)
+            except OSError:
+                log.error("Can't modify tags for a non-existing path <{}>".format(fpath))
+                yield fpath, None
+                continue
+
+            if not (is_dir and recursive):
+                yield fpath, is_dir
+            else:
+                for file_path in iter_tree_files(fpath):
+                    yield file_path, False
+
+def iter_tree_files(dirpath):
+    """Yield the paths of the files inside dirpath and all its subfolders, skipping the metadata folders."""
+
+    pending = [dirpath]
+    while pending:
+        current = pending.pop()
+        mdata_folder = mdata.MData.get_mdata_folder(current)
+
+        try:
+            entries = list(utils.iter_dir_entries(current))
+        except OSError as e:
+            log.error("Unable to list files for folder <{}> because {}".format(current, e))
+            continue
+
+        for path, is_dir in entries:
+            if not is_dir:
+                yield path
+            elif path != mdata_folder:
+                pending.append(path)
+
+def get_files_for_tags(mode, *tags, **kwargs):
+    """Get a list of paths that match the given tags with the provided mode.
+    Matching folders are returned as a single path if expand_dirs=False is passed.
+    If sort=key is passed (one of SORT_KEYS), the paths are ordered by it, and limit=k returns only the first k ones."""
+
+    sort = kwargs.pop("sort", None)
+    limit = kwargs.pop("limit", 0)
+
+    return get_sorted_paths(iter_files_for_tags(mode, *tags, **kwargs), sort, limit)
+
+def iter_files_for_tags(mode, *tags, **kwargs):
+    """Yield the paths that match the given tags with the provided mode. Index results are cached until one of the tags is modified.
+    Tags ending with '*' (e.g. 'proj*') match any tag starting with the rest. Matching folders are yielded as a single path
+    if expand_dirs=False is passed."""
+
+    global file_index
+    global dir_index
+
+    if any(query.is_prefix(t) for t in tags):
+        # prefix patterns are expanded by the query planner, their results aren't cached
+        # as new tags matching them can appear at any time
+        tree = query.make_tags_query(mode, tags)
+        return iter_files_for_tree(tree, **kwargs) if tree is not None else iter(())
+
+    # folders that were never loaded are not known by the indexes yet
+    index_dbase()
+
+    key = query_cache.make_key(mode, *tags)
+    matches = query_cache.get(key)
+    if matches is None:
+        matches = (get_dir_index().query(mode, *tags), file_index.query(mode, *tags))
+        query_cache.put(key, matches, tags)
+
+    # folders contents are expanded on each call, to include files added since the result was cached
+    return iter_matching_paths(*matches, **kwargs)
+
+def get_files_for_query(expression, **kwargs):
+    """Get a list of paths that match the boolean query 'expression', e.g. '(photo AND 2023) AND NOT raw'.
+    Matching folders are returned as a single path if expand_dirs=False is passed.
+    If sort=key is passed (one of SORT_KEYS), the paths are ordered by it, and limit=k returns only the first k ones."""
+
+    sort = kwargs.pop("sort", None)
+    limit = kwargs.pop("limit", 0)
+
+    return get_sorted_paths(iter_files_for_query(expression, **kwargs), sort, limit)
+
+def iter_files_for_query(expression, **kwargs):
+    """Yield the paths that match the boolean query 'expression'. Matching folders are yielded as a single path if expand_dirs=False is passed."""
+
+    tree = query.parse_query(expression)
+    if tree is None:
+        return iter(())
+
+    return iter_files_for_tree(tree, **kwargs)
+
+def iter_files_for_tree(tree, **kwargs):
+    """Yield the paths that match the query syntax tree. Matching folders are yielded as a single path if expand_dirs=False is passed."""
+
+    global file_index
+    global dir_index
+
+    index_dbase()
+
+    has_ranges = query.has_ranges(tree)
+    if has_ranges:
+        index_file_stats()
+
+    dir_plan = plan_dirs_query(tree)
+    file_plan = query.plan_query(tree, file_index)
+
+    # files are checked against the whole query with the tags of their folder plus their own,
+    # so that negations and ranges apply to the files of the matching folders too
+    kwargs["file_plan"] = file_plan
+    kwargs["read_stats"] = has_ranges
+
+    return iter_matching_paths(dir_plan.execute(get_dir_index()), file_plan.execute(file_index), **kwargs)
+
+def is_tag_used(tag):
+    """Returns True if tag is assigned to some file or folder."""
+
+    global file_index
+    global dir_index
+
+    return bool(file_index.cardinality(tag) or dir_index.cardinality(tag))
+
+def complete_tags(prefix):
+    """Returns the sorted list of the tags in use starting with prefix."""
+
+    index_dbase()
+
+    return [t for t in index.TAGS.complete(prefix) if is_tag_used(t)]
+
+def suggest_tags(tag):
+    """Returns the sorted list of the tags in use one edit away from tag, to correct a misspelled tag."""
+
+    index_dbase()
+
+    return [t for t in index.TAGS.suggest(tag) if is_tag_used(t)]
+
+def plan_dirs_query(tree):
+    """Returns the Plan for the query syntax tree against the folders index. Range predicates only apply to files,
+    the plan matches the folders whose files could match them."""
+
+    return query.plan_query(query.relax_ranges(tree), get_dir_index())
+
+def explain_query(expression):
+    """Returns a description of the execution plans for the boolean query 'expression'."""
+
+    global file_index
+    global dir_index
+
+    tree = query.parse_query(expression)
+    if tree is None:
+        return ""
+
+    index_dbase()
+
+    if query.has_ranges(tree):
+        index_file_stats()
+
+    dir_plan = plan_dirs_query(tree)
+    file_plan = query.plan_query(tree, file_index)
+
+    return "folders ({} indexed{}):\n{}\nfiles ({} indexed):\n{}".format(len(dir_index), ", recursive" if recursive_tags else "",
+                                                                      dir_plan.explain(1), len(file_index), file_plan.explain(1))
+
+def get_sorted_paths(paths, sort=None, limit=0):
+    """Returns the list of 'paths', ordered by 'sort' if provided (see iter_sorted_paths), with at most 'limit' paths (all of them if 0)."""
+
+    if sort is not None:
+        paths = iter_sorted_paths(paths, sort)
+
+    return list(itertools.islice(paths, limit or None))
+
+def iter_sorted_paths(paths, sort):
+    """Yield 'paths' ordered by 'sort', one of SORT_KEYS: the most recently modified or created, or the largest files first,
+    or by name. Paths that don't exist are skipped, unless sorting by name.
+    The paths are kept in a heap, built in O(n) and popped on demand, so that the first k paths cost O(n + k log n)."""
+
+    try:
+        attribute = SORT_KEYS[sort]
+    except KeyError:
+        log.error("Invalid sort key '{}'. Please provide one of {}".format(sort, sorted(SORT_KEYS)))
+        return
+
+    if attribute is None:
+        heap = [(os.path.basename(path), path) for path in paths]
     else:
-        log.error("Can't modify tags for a non-existing path <{}>".format(fpath))
+        # larger values first
+        heap = [(-value, path) for value, path in iter_stat_values(paths, attribute) if value is not None]
 
-def get_files_for_tags(mode, *tags):
-    """Get a list of paths that match the given tags with the provided mode."""
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[1]
 
-    global folder_dbase
+def iter_stat_values(paths, attribute):
+    """Yield (value, path) with the value of the stat attribute (one of mdata.STAT_ATTRIBUTES) for each path, None if it doesn't exist.
+    Values are taken from the range indexes of file_index when available, otherwise the missing ones are read
+    once per folder and the values of the indexed files are kept in the range indexes."""
+
+    global file_index
+
+    position = mdata.STAT_ATTRIBUTES.index(attribute)
+
+    values = []
+    folders = {}
+    for path in paths:
+        value = file_index.get_attribute(path, attribute)
+        if value is None:
+            dirpath, fname = os.path.split(path)
+            folders.setdefault(dirpath, []).append(fname)
+
+        values.append((value, path))
+
+    folder_stats = {}
+    for dirpath, fnames in folders.iteritems():
+        try:
+            folder_stats[dirpath] = dict(utils.iter_dir_stats(dirpath, fnames))
+        except OSError:
+            folder_stats[dirpath] = {}
+
+    for value, path in values:
+        if value is None:
+            dirpath, fname = os.path.split(path)
+
+            stat_result = folder_stats[dirpath].get(fname)
+            if stat_result is not None:
+                value = mdata.get_stat_values(stat_result)[position]
+
+            if path in file_index:
+                set_file_stat(path, stat_result)
 
-    matching_mdata = []
+        yield value, path
 
-    for dirpath, db_entry in folder_dbase.items():
-        if db_entry.dir_mdata.filter(mode, *tags):
-            # if dir_mdata matches the tags, return all files inside this dirpath
-            matching_mdata.extend([os.path.join(dirpath, fp) for fp in os.listdir(dirpath)])
+def get_matching_paths(matching_dirs, matching_files, expand_dirs=True, recursive=None):
+    """Returns the list of paths for the matching folders and files."""
+
+    return list(iter_matching_paths(matching_dirs, matching_files, expand_dirs, recursive))
+
+def iter_matching_paths(matching_dirs, matching_files, expand_dirs=True, recursive=None, file_plan=None, read_stats=False):
+    """Yield the paths for the matching folders and files. Each matching folder is expanded into the files
+    it contains once it's reached, or yielded as a single path if 'expand_dirs' is False.
+    If 'recursive' is True (defaults to recursive_tags), folders are expanded into the files of all their subfolders.
+    If 'file_plan' is provided, files are only yielded if they match it with the tags of their folder plus their own,
+    and their stat values if 'read_stats' is True, see filter_folder_files."""
+
+    if recursive is None:
+        recursive = recursive_tags
+
+    if recursive:
+        # folders inside another matching folder are already included by it
+        expanded_dirs = sorted(d for d in matching_dirs if inherited_index.get_closest_ancestor(d) not in matching_dirs)
+    else:
+        expanded_dirs = matching_dirs
+
+    expanded_paths = iter_expanded_paths(expanded_dirs, matching_dirs, expand_dirs, recursive)
+    if file_plan is not None and expand_dirs:
+        expanded_paths = filter_folder_files(expanded_paths, file_plan, recursive, read_stats)
+
+    for path in expanded_paths:
+        yield path
+
+    # else, yield the matching files not already included by their folder
+    for fpath in matching_files:
+        dirpath = get_tagged_folder(os.path.dirname(fpath), recursive)
+
+        if dirpath in matching_dirs:
+            continue
+
+        if file_plan is not None and dirpath is not None:
+            # the tags of the folder may exclude the file from a negation
+            dir_tags = get_dir_index().get_tags(dirpath)
+            values = dict((name, file_index.get_attribute(fpath, name)) for name in mdata.STAT_ATTRIBUTES) if read_stats else {}
+
+            if dir_tags and not file_plan.matches(dir_tags | file_index.get_tags(fpath), values):
+                continue
+
+        yield fpath
+
+def get_tagged_folder(dirpath, recursive):
+    """Returns the folder whose tags apply to the files inside dirpath: dirpath itself, or its closest tagged
+    ancestor if 'recursive' is True and dirpath has no tags of its own (None if there's none)."""
+
+    if recursive and dirpath not in inherited_index.own_tags:
+        return inherited_index.get_closest_ancestor(dirpath)
+
+    return dirpath
+
+def iter_expanded_paths(expanded_dirs, matching_dirs, expand_dirs, recursive):
+    """Yield the paths of the files inside the expanded_dirs folders, or the folders themselves if 'expand_dirs' is False.
+    See iter_matching_paths."""
+
+    # if a folder matches the tags, yield all files inside its dirpath
+    for dirpath in expanded_dirs:
+        if not expand_dirs:
+            yield dirpath
+        elif recursive:
+            for fpath in iter_folder_files(dirpath, matching_dirs):
+                yield fpath
         else:
-            # else, filter each .mdata file in this directory individually
-            for mdata_file in db_entry.mdata_list:
-                if mdata_file.filter(mode, *tags):
-                    matching_mdata.append(mdata_file)
+            try:
+                # the listing is only read again from disk when the folder mtime changes. Subfolders,
+                # including the metadata folder, are left out as in recursive mode
+                fnames = listing_cache.listfiles(dirpath)
+            except OSError as e:
+                log.error("Unable to list files for folder <{}> because {}".format(dirpath, e))
+                continue
+
+            for fname in fnames:
+                yield os.path.join(dirpath, fname)
+
+def filter_folder_files(fpaths, file_plan, recursive, read_stats=False):
+    """Yield the paths in fpaths, grouped by folder, matching file_plan with the tags of their folder plus their own,
+    and their stat values if 'read_stats' is True. Subfolders, including the metadata folders, are skipped, as the
+    query only applies to files. The stat values are read once per folder, for its files only."""
+
+    global file_index
+
+    dirs_index = get_dir_index()
+    current_dirpath = None
+
+    for fpath in fpaths:
+        dirpath, fname = os.path.split(fpath)
 
-    return matching_mdata
+        if dirpath != current_dirpath:
+            current_dirpath = dirpath
+
+            try:
+                fnames = set(listing_cache.listfiles(dirpath))
+            except OSError as e:
+                log.error("Unable to list files for folder <{}> because {}".format(dirpath, e))
+                fnames = set()
+
+            stats = None
+            if read_stats:
+                try:
+                    stats = dict(utils.iter_dir_stats(dirpath, fnames))
+                except OSError as e:
+                    log.error("Unable to list files for folder <{}> because {}".format(dirpath, e))
+                    stats = {}
+
+            dirpath = get_tagged_folder(dirpath, recursive)
+            dir_tags = dirs_index.get_tags(dirpath) if dirpath is not None else set()
+
+        if fname not in fnames:
+            continue
+
+        values = {}
+        if stats is not None:
+            stat_result = stats.get(fname)
+            if stat_result is None:
+                continue
+
+            values = dict(zip(mdata.STAT_ATTRIBUTES, mdata.get_stat_values(stat_result)))
+
+        if file_plan.matches(dir_tags | file_index.get_tags(fpath), values):
+            yield fpath
+
+def iter_folder_files(dirpath, matching_dirs):
+    """Yield the paths of the files inside dirpath and all its subfolders, skipping the metadata folders
+    and the tagged subfolders not in matching_dirs."""
+
+    def on_error(e):
+        log.error("Unable to list files for folder <{}> because {}".format(e.filename, e))
+
+    for walked_dirpath, subdirs, fnames in listing_cache.walk(dirpath, on_error):
+        mdata_folder = os.path.basename(mdata.MData.get_mdata_folder(walked_dirpath))
+
+        for subdir in list(subdirs):
+            subdir_path = os.path.join(walked_dirpath, subdir)
+
+            # subfolders with tags of their own only match if their effective tags do
+            if subdir == mdata_folder or (subdir_path in inherited_index.own_tags and subdir_path not in matching_dirs):
+                subdirs.remove(subdir)
+
+        for fname in fnames:
+            yield os.path.join(walked_dirpath, fname)
 
 def set_dbase_password(current_pw, new_pw):
     """Update the current encription password."""
 
+    global config_dirty
+
     try:
         if not current_pw == config["pw"]:
             log.error("Wrong password entered - returning.")
@@ -307,12 +1351,102 @@ def set_dbase_password(current_pw, new_pw):
         # no password stored - assume it's first initialization
         pass
 
-    # if partial loading of dbase folders is implemented, take care of load and save
-    # the unloaded .mdata not to mess with the encription
+    old_pw = config.get("pw")
 
-    config["pw"] = new_pw
+    def use_new_pw():
+        config["pw"] = new_pw
 
-    return True
+    def use_old_pw():
+        if old_pw is None:
+            config.pop("pw", None)
+        else:
+            config["pw"] = old_pw
+
+    # re-encrypt all the records with the new password, and save the config right away
+    # so that it's always in sync with the records on disk
+    rewrite_dbase(use_new_pw, use_old_pw)
+    use_new_pw()
+    config_dirty = True
+
+    # the key for the old password is no longer needed
+    security.clear_key_cache()
+
+    return save()
+
+def open_store(storage):
+    """Returns the record store for the 'storage' backend (a value from utils.STORAGE), or None for .mdata files."""
+
+    global store_path
+
+    if storage == utils.STORAGE.SQLITE:
+        return store.SQLiteStore(store_path)
+    elif storage != utils.STORAGE.FILES:
+        log.error("Invalid storage specified! ({}) Please provide a value from utils.STORAGE enum".format(storage))
+
+    return None
+
+def set_record_store(new_store):
+    """Use new_store (or .mdata files if None) to load and save the metadata records."""
+
+    global record_store
+
+    record_store = new_store
+    mdata.set_store_hook(new_store)
+
+def migrate_store(storage):
+    """Move all the metadata records to the 'storage' backend (a value from utils.STORAGE)."""
+
+    global config_dirty
+
+    if storage == config.get("storage", utils.STORAGE.FILES):
+        log.error("Metadata is already stored with {} storage.".format(utils.STORAGE.get_name(storage)))
+        return False
+
+    old_store = record_store
+    new_store = open_store(storage)
+
+    rewrite_dbase(lambda: set_record_store(new_store), lambda: set_record_store(old_store))
+
+    set_record_store(new_store)
+    config["storage"] = storage
+    config_dirty = True
+
+    if old_store:
+        old_store.close()
+
+    return save()
+
+def rewrite_dbase(apply_new_settings, restore_settings):
+    """Load every folder with the current settings and save it with the new ones, one folder at a time.
+    apply_new_settings and restore_settings are callables switching between the two."""
+
+    global loaded_entries
+
+    # flush pending changes with the current settings first
+    for db_entry in folder_dbase.values():
+        db_entry.save()
+
+    if record_store:
+        record_store.commit()
+
+    result = True
+    for db_entry in folder_dbase.values():
+        was_loaded = db_entry.is_loaded
+
+        db_entry.load()
+
+        apply_new_settings()
+        db_entry.save(force=True)
+        result = result and not db_entry.is_dirty
+        if record_store:
+            record_store.commit()
+        restore_settings()
+
+        if not was_loaded:
+            db_entry.unload()
+            loaded_entries.pop(db_entry.descriptor.dirpath, None)
+
+    return result
 
 def has_pw():
     """Returns True if a user password has already been set, False otherwise."""
@@ -356,7 +1490,7 @@ if __name__ == "__main__":
     files = get_files_for_tags(utils.FILTERMODE.ANY, "inherited_tag", "non_existent_tag")
 
     try:
-        os.startfile(files[0].fpath)
+        os.startfile(files[0])
     except IndexError:
         log.error("No match found for given tags & mode!")
 
@@ -0,0 +1,784 @@
+"""
+This module contains the TagIndex class, an in-memory inverted index mapping each tag
+to the records (file or folder paths) tagged with it.
+
+Tags are interned to integer ids by a TagDictionary, and records to dense integer ids,
+so that each posting list is a Bitmap of record ids: a sorted array of ints while sparse,
+a bitmap combined with word-level bitwise operations once dense.
+
+e.g.
+
+import index
+
+tag_index = index.TagIndex()
+tag_index.add(r'C:\test_mdata_file.txt', "text", "important")
+tag_index.add(r'C:\other_file.txt', "text")
+
+# returns set([r'C:\test_mdata_file.txt'])
+print tag_index.query(utils.FILTERMODE.ALL, "text", "important")
+
+# numeric attributes of the records are kept in sorted indexes, for range queries
+tag_index.set_attributes(r'C:\test_mdata_file.txt', [("size", 2048)])
+
+# returns set([r'C:\test_mdata_file.txt'])
+print tag_index.resolve(tag_index.get_range("size", 1024, None))
+
+Classes:
+    Bitmap
+    InheritedTagIndex
+    RangeIndex
+    TagDictionary
+    TagIndex
+
+Variables:
+    TAGS
+"""
+
+import binascii
+import logging as log
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve the utils module
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import utils
+
+# { byte value : positions of its set bits }, used to decode bitmaps
+BIT_POSITIONS = [tuple(b for b in range(8) if value & (1 << b)) for value in range(256)]
+NON_ZERO_BYTE_RE = re.compile(r'[^\x00]')
+
+class Bitmap(object):
+    """Compressed set of non-negative ints: a sorted array while sparse, a bitmap once dense."""
+
+    __slots__ = ("ids", "bits", "count")
+
+    def __init__(self, ids=()):
+        """Initialize the bitmap with the provided ids."""
+
+        # sparse representation: sorted array of ids
+        self.ids = array("I", sorted(set(ids)))
+        # dense representation: bit i of byte i >> 3 is set for each id i
+        self.bits = None
+        self.count = len(self.ids)
+
+        self._compact()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, i):
+        if self.bits is not None:
+            return (i >> 3) < len(self.bits) and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+        position = bisect_left(self.ids, i)
+        return position < len(self.ids) and self.ids[position] == i
+
+    def __iter__(self):
+        """Iterate over the ids in ascending order."""
+
+        if self.bits is None:
+            return iter(self.ids)
+
+        return self._iter_bits()
+
+    def _iter_bits(self):
+        """Iterate over the set bits of the dense representation, skipping zero bytes in C."""
+
+        bits = self.bits
+        for match in NON_ZERO_BYTE_RE.finditer(str(bits)):
+            offset = match.start()
+            for b in BIT_POSITIONS[bits[offset]]:
+                yield (offset << 3) | b
+
+    def add(self, i):
+        """Add the id i."""
+
+        if self.bits is not None:
+            if (i >> 3) >= len(self.bits):
+                self.bits.extend(bytearray((i >> 3) + 1 - len(self.bits)))
+
+            mask = 1 << (i & 7)
+            if not self.bits[i >> 3] & mask:
+                self.bits[i >> 3] |= mask
+                self.count += 1
+            return
+
+        position = bisect_left(self.ids, i)
+        if position < len(self.ids) and self.ids[position] == i:
+            return
+
+        self.ids.insert(position, i)
+        self.count += 1
+
+        self._compact()
+
+    def discard(self, i):
+        """Remove the id i, if present."""
+
+        if self.bits is not None:
+            mask = 1 << (i & 7)
+            if (i >> 3) < len(self.bits) and self.bits[i >> 3] & mask:
+                self.bits[i >> 3] &= ~mask & 0xFF
+                self.count -= 1
+                self._compact()
+            return
+
+        position = bisect_left(self.ids, i)
+        if position < len(self.ids) and self.ids[position] == i:
+            del self.ids[position]
+            self.count -= 1
+
+    def _compact(self):
+        """Switch to the representation using less memory."""
+
+        if not self.count:
+            self.ids = array("I")
+            self.bits = None
+            return
+
+        if self.bits is None:
+            # the bitmap would need one byte every 8 ids up to the largest one
+            if (self.ids[-1] >> 3) + 1 < self.ids.itemsize * self.count:
+                bits = bytearray((self.ids[-1] >> 3) + 1)
+                for i in self.ids:
+                    bits[i >> 3] |= 1 << (i & 7)
+                self.bits = bits
+                self.ids = array("I")
+        elif self.count * self.ids.itemsize * 2 < len(self.bits):
+            # only go back to the sparse representation well below the threshold,
+            # not to switch back and forth around it
+            self.ids = array("I", self._iter_bits())
+            self.bits = None
+
+    def to_long(self):
+        """Returns the bitmap as a long, with bit i set for each id i."""
+
+        if self.bits is not None:
+            bits = self.bits
+        else:
+            bits = bytearray((self.ids[-1] >> 3) + 1) if self.count else bytearray()
+            for i in self.ids:
+                bits[i >> 3] |= 1 << (i & 7)
+
+        if not bits:
+            return 0
+
+        # bytes are stored little-endian, hexlify reads them big-endian
+        return int(binascii.hexlify(str(bits[::-1])), 16)
+
+    @classmethod
+    def from_long(cls, value):
+        """Returns a Bitmap with the ids corresponding to the bits set in value."""
+
+        bitmap = cls()
+        if value <= 0:
+            return bitmap
+
+        hex_value = "%x" % value
+        if len(hex_value) % 2:
+            hex_value = "0" + hex_value
+
+        bitmap.bits = bytearray(binascii.unhexlify(hex_value))[::-1]
+        bitmap.count = bin(value).count("1")
+        bitmap._compact()
+
+        return bitmap
+
+    def __and__(self, other):
+        if self.bits is not None and other.bits is not None:
+            return Bitmap.from_long(self.to_long() & other.to_long())
+
+        # at least one side is sparse: drive the intersection from its ids
+        small, large = (self, other) if self.bits is None else (other, self)
+        if large.bits is None and len(small) > len(large):
+            small, large = large, small
+
+        if large.bits is None and len(large) < 16 * len(small):
+            return Bitmap(set(small.ids).intersection(large.ids))
+
+        # bisect (or bit test) each id of the small side into the large one
+        return Bitmap(i for i in small.ids if i in large)
+
+    def __or__(self, other):
+        if self.bits is None and other.bits is None:
+            return Bitmap(set(self.ids).union(other.ids))
+
+        return Bitmap.from_long(self.to_long() | other.to_long())
+
+    def __sub__(self, other):
+        if self.bits is None:
+            return Bitmap(i for i in self.ids if i not in other)
+
+        return Bitmap.from_long(self.to_long() & ~other.to_long())
+
+    def copy(self):
+        """Returns a copy of this bitmap."""
+
+        bitmap = Bitmap()
+        bitmap.ids = array("I", self.ids)
+        bitmap.bits = bytearray(self.bits) if self.bits is not None else None
+        bitmap.count = self.count
+
+        return bitmap
+
+    @staticmethod
+    def union(*bitmaps):
+        """Returns the union of all the provided bitmaps."""
+
+        if all(b.bits is None for b in bitmaps):
+            return Bitmap(set().union(*[b.ids for b in bitmaps]))
+
+        value = 0
+        for b in bitmaps:
+            value |= b.to_long()
+
+        return Bitmap.from_long(value)
+
+class TagDictionary(object):
+    """Interns tags to dense integer ids, and looks up the known tags by prefix or spelling."""
+
+    def __init__(self):
+        """Initialize an empty dictionary."""
+
+        # tag -> tag id
+        self.ids = {}
+        # tag id -> tag
+        self.names = []
+        # tags in ascending order for prefix searches, sorted again on the first search after new tags are added
+        self.sorted_names = None
+        # characters used by the tags, to generate the spelling variations of a tag
+        self.alphabet = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_id(self, tag, create=True):
+        """Returns the id for tag, assigning a new one if needed and 'create' is True (None otherwise)."""
+
+        try:
+            return self.ids[tag]
+        except KeyError:
+            if not create:
+                return None
+
+        if isinstance(tag, str):
+            # share the same string object between all the records using this tag
+            tag = intern(tag)
+
+        tag_id = self.ids[tag] = len(self.names)
+        self.names.append(tag)
+
+        self.sorted_names = None
+        self.alphabet.update(tag)
+
+        return tag_id
+
+    def get_name(self, tag_id):
+        """Returns the tag for tag_id."""
+
+        return self.names[tag_id]
+
+    def complete(self, prefix):
+        """Returns the sorted list of known tags starting with prefix."""
+
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.names)
+
+        start = end = bisect_left(self.sorted_names, prefix)
+        while end < len(self.sorted_names) and self.sorted_names[end].startswith(prefix):
+            end += 1
+
+        return self.sorted_names[start:end]
+
+    def suggest(self, tag):
+        """Returns the sorted list of known tags one edit away from tag: a character deleted, inserted,
+        replaced or two adjacent characters swapped. The variations are looked up, not the known tags scanned."""
+
+        splits = [(tag[:i], tag[i:]) for i in range(len(tag) + 1)]
+
+        variations = set(left + right[1:] for left, right in splits if right)
+        variations.update(left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1)
+        variations.update(left + c + right[1:] for left, right in splits if right for c in self.alphabet)
+        variations.update(left + c + right for left, right in splits for c in self.alphabet)
+        variations.discard(tag)
+
+        return sorted(v for v in variations if v in self.ids)
+
+# the tag dictionary shared by all the indexes
+TAGS = TagDictionary()
+
+class RangeIndex(object):
+    """Sorted secondary index { record id : value } on a numeric attribute of the records, so that
+    the records with a value inside a range are found with two bisections."""
+
+    def __init__(self):
+        """Initialize an empty index."""
+
+        # values sorted in ascending order, and the record id of each value
+        self.values = array("d")
+        self.rids = array("I")
+        # record id -> value, None for the records whose value is unknown
+        self.record_values = {}
+        # all the ids in self.record_values
+        self.all_rids = Bitmap()
+
+    def __len__(self):
+        return len(self.values)
+
+    def set(self, rid, value):
+        """Set the value for the record id rid (None if unknown)."""
+
+        if rid in self.record_values:
+            if self.record_values[rid] == value:
+                return
+            self.discard(rid)
+
+        self.record_values[rid] = value
+        self.all_rids.add(rid)
+
+        if value is not None:
+            position = bisect_right(self.values, value)
+            self.values.insert(position, value)
+            self.rids.insert(position, rid)
+
+    def discard(self, rid):
+        """Remove the value for the record id rid, if any."""
+
+        try:
+            value = self.record_values.pop(rid)
+        except KeyError:
+            return
+
+        self.all_rids.discard(rid)
+
+        if value is not None:
+            # only the records with the same value are scanned
+            start = bisect_left(self.values, value)
+            position = start + self.rids[start:bisect_right(self.values, value)].index(rid)
+            del self.values[position]
+            del self.rids[position]
+
+    def get_bounds(self, low=None, high=None):
+        """Returns the (start, end) positions of the values in the range [low, high) (None for an unbounded side)."""
+
+        start = 0 if low is None else bisect_left(self.values, low)
+        end = len(self.values) if high is None else bisect_left(self.values, high)
+
+        return start, max(start, end)
+
+    def count(self, low=None, high=None):
+        """Returns the number of records with a value in the range [low, high)."""
+
+        start, end = self.get_bounds(low, high)
+        return end - start
+
+    def get_range(self, low=None, high=None):
+        """Returns the Bitmap of the record ids with a value in the range [low, high)."""
+
+        start, end = self.get_bounds(low, high)
+        return Bitmap(self.rids[start:end])
+
+    def ids(self):
+        """Returns the Bitmap of the record ids with a value, known or not. The returned Bitmap must not be modified."""
+
+        return self.all_rids
+
+class TagIndex(object):
+    """Inverted index { tag id : Bitmap(record ids) }, kept in sync with the MData tag lists."""
+
+    def __init__(self, tag_dictionary=TAGS):
+        """Initialize empty posting lists and the per-record tag ids."""
+
+        self.tags = tag_dictionary
+
+        # tag id -> Bitmap of the record ids tagged with it
+        self.postings = {}
+        # record id -> tuple of tag ids, used to update the postings when a record is reloaded
+        self.records = {}
+        # records (file or folder paths) are interned to dense ids, reusing the ids of removed records
+        self.rids = {}
+        self.paths = []
+        self.free_rids = []
+        # all the ids in self.records
+        self.all_rids = Bitmap()
+        # attribute name -> RangeIndex of the attribute values of the records
+        self.attributes = {}
+
+        # functions called with the record path and the list of modified tags whenever a posting list changes
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, path):
+        return self.rids.get(path) in self.records
+
+    def get_rid(self, path, create=True):
+        """Returns the dense id for the record path, assigning one if needed and 'create' is True (None otherwise)."""
+
+        try:
+            return self.rids[path]
+        except KeyError:
+            if not create:
+                return None
+
+        if self.free_rids:
+            rid = self.free_rids.pop()
+            self.paths[rid] = path
+        else:
+            rid = len(self.paths)
+            self.paths.append(path)
+
+        self.rids[path] = rid
+        return rid
+
+    def add(self, path, *tags):
+        """Add 'tags' to the record 'path'."""
+
+        self.notify(path, self._add(path, tags))
+
+    def _add(self, path, tags):
+        """Add 'tags' to the record 'path' without calling the listeners. Returns the list of added tag ids."""
+
+        rid = self.get_rid(path)
+        record_tags = self.records.get(rid, ())
+
+        new_tags = []
+        for t in tags:
+            tag_id = self.tags.get_id(t)
+            if tag_id in record_tags or tag_id in new_tags:
+                continue
+
+            new_tags.append(tag_id)
+            self.postings.setdefault(tag_id, Bitmap()).add(rid)
+
+        if new_tags:
+            self.records[rid] = record_tags + tuple(new_tags)
+            self.all_rids.add(rid)
+        elif not record_tags:
+            self._release_rid(path, rid)
+
+        return new_tags
+
+    def remove(self, path, *tags):
+        """Remove 'tags' from the record 'path'."""
+
+        self.notify(path, self._remove(path, tags))
+
+    def _remove(self, path, tags):
+        """Remove 'tags' from the record 'path' without calling the listeners. Returns the set of removed tag ids."""
+
+        rid = self.rids.get(path)
+        try:
+            record_tags = self.records[rid]
+        except KeyError:
+            return set()
+
+        removed = set(self.tags.get_id(t, create=False) for t in tags).intersection(record_tags)
+        for tag_id in removed:
+            posting = self.postings[tag_id]
+            posting.discard(rid)
+            if not posting:
+                del self.postings[tag_id]
+
+        record_tags = tuple(tag_id for tag_id in record_tags if tag_id not in removed)
+        if record_tags:
+            self.records[rid] = record_tags
+        else:
+            del self.records[rid]
+            self.all_rids.discard(rid)
+            self._release_rid(path, rid)
+
+        return removed
+
+    def add_listener(self, listener):
+        """Register listener(path, tags) to be called with the record path and the list of tags added to or removed from it."""
+
+        self.listeners.append(listener)
+
+    def notify(self, path, tag_ids):
+        """Call the listeners for the modified tag_ids of the record path."""
+
+        if not (self.listeners and tag_ids):
+            return
+
+        tags = [self.tags.get_name(tag_id) for tag_id in tag_ids]
+        for listener in self.listeners:
+            listener(path, tags)
+
+    def _release_rid(self, path, rid):
+        """Free the id of a record without tags, to be reused by the next new record."""
+
+        del self.rids[path]
+        self.paths[rid] = None
+        self.free_rids.append(rid)
+
+        for attribute in self.attributes.values():
+            attribute.discard(rid)
+
+    def set_attributes(self, path, values):
+        """Set the attribute values of the record 'path', a list of (name, value) pairs (None for unknown values).
+        Records without tags aren't indexed, their values are ignored."""
+
+        rid = self.rids.get(path)
+        if rid not in self.records:
+            return
+
+        for name, value in values:
+            self.attributes.setdefault(name, RangeIndex()).set(rid, value)
+
+    def get_attribute(self, path, name):
+        """Returns the value of the attribute 'name' for the record 'path', None if it's not known."""
+
+        try:
+            return self.attributes[name].record_values.get(self.rids.get(path))
+        except KeyError:
+            return None
+
+    def get_range(self, name, low=None, high=None):
+        """Returns the Bitmap of record ids whose attribute 'name' has a value in the range [low, high)."""
+
+        try:
+            return self.attributes[name].get_range(low, high)
+        except KeyError:
+            return Bitmap()
+
+    def count_range(self, name, low=None, high=None):
+        """Returns the number of records whose attribute 'name' has a value in the range [low, high)."""
+
+        try:
+            return self.attributes[name].count(low, high)
+        except KeyError:
+            return 0
+
+    def get_unset_attribute(self, name):
+        """Returns the set of record paths without a value, known or not, for the attribute 'name'."""
+
+        try:
+            return self.resolve(self.all_rids - self.attributes[name].ids())
+        except KeyError:
+            return self.resolve(self.all_rids)
+
+    def set_tags(self, path, tags):
+        """Replace all tags of the record 'path' with 'tags'. Only the tags that actually change are updated, so the
+        record keeps its id and attribute values, and the listeners are called once with the changed tags."""
+
+        old_tags = self.get_tags(path)
+        tags = set(tags)
+
+        # tags are added first, so that a record keeping some tags is never released
+        changed = self._add(path, tags - old_tags)
+        changed.extend(self._remove(path, old_tags - tags))
+
+        self.notify(path, changed)
+
+    def discard(self, path):
+        """Remove the record 'path' from the index."""
+
+        self.remove(path, *self.get_tags(path))
+
+    def get_tags(self, path):
+        """Returns the set of tags indexed for the record 'path'."""
+
+        return set(self.tags.get_name(tag_id) for tag_id in self.records.get(self.rids.get(path), ()))
+
+    def get_posting(self, tag):
+        """Returns the Bitmap of record ids tagged with 'tag'. The returned Bitmap must not be modified."""
+
+        return self.postings.get(self.tags.get_id(tag, create=False)) or Bitmap()
+
+    def cardinality(self, tag):
+        """Returns the number of records tagged with 'tag'."""
+
+        return len(self.get_posting(tag))
+
+    def ids(self):
+        """Returns the Bitmap of all the indexed record ids. The returned Bitmap must not be modified."""
+
+        return self.all_rids
+
+    def resolve(self, rids):
+        """Returns the set of record paths for the record ids in rids."""
+
+        return set(self.paths[rid] for rid in rids)
+
+    def query(self, mode, *tags):
+        """Returns the set of record paths matching 'tags' based on 'mode'."""
+
+        if not tags:
+            return set()
+
+        postings = [self.get_posting(t) for t in set(tags)]
+
+        if mode == utils.FILTERMODE.ANY:
+            return self.resolve(Bitmap.union(*postings))
+        elif mode == utils.FILTERMODE.ALL:
+            # intersect the posting lists starting from the shortest one, so that the
+            # cost is bound by the size of the most selective tag
+            postings.sort(key=len)
+            result = postings[0]
+            for posting in postings[1:]:
+                if not result:
+                    break
+                result = result & posting
+            return self.resolve(result)
+        else:
+            log.error("Invalid filter mode specified! ({}) Please provide a value from utils.FILTERMODE enum".format(mode))
+            return set()
+
+class InheritedTagIndex(object):
+    """Index of the effective tags of folders: the tags of a folder plus the tags of all its ancestors.
+
+    The effective tags are precomputed into a TagIndex, and only the folder and its descendants
+    are updated when the tags of a folder change."""
+
+    def __init__(self, tag_dictionary=TAGS):
+        """Initialize an empty index."""
+
+        # folder path -> frozenset of its own tags
+        self.own_tags = {}
+        # sorted folder paths, the descendants of a folder are a contiguous slice
+        self.dirpaths = []
+        # the effective tags of each folder
+        self.effective = TagIndex(tag_dictionary)
+
+    def __len__(self):
+        return len(self.own_tags)
+
+    def set_tags(self, dirpath, tags):
+        """Replace the own tags of the folder dirpath with 'tags', updating the effective tags of its descendants."""
+
+        tags = frozenset(tags)
+        if tags == self.own_tags.get(dirpath, frozenset()):
+            return
+
+        position = bisect_left(self.dirpaths, dirpath)
+        if tags:
+            if dirpath not in self.own_tags:
+                self.dirpaths.insert(position, dirpath)
+            self.own_tags[dirpath] = tags
+        else:
+            del self.own_tags[dirpath]
+            del self.dirpaths[position]
+
+        self.refresh(dirpath)
+        for descendant in self.get_descendants(dirpath):
+            self.refresh(descendant)
+
+    def refresh(self, dirpath):
+        """Recompute the effective tags of dirpath from its own tags and its closest indexed ancestor."""
+
+        if dirpath not in self.own_tags:
+            self.effective.discard(dirpath)
+            return
+
+        self.effective.set_tags(dirpath, self.own_tags[dirpath] | self.get_inherited_tags(dirpath))
+
+    def get_inherited_tags(self, dirpath):
+        """Returns the set of tags dirpath inherits from its ancestors."""
+
+        ancestor = self.get_closest_ancestor(dirpath)
+        if ancestor is None:
+            return set()
+
+        # the effective tags of the closest ancestor already include the ones above it
+        return self.effective.get_tags(ancestor)
+
+    def get_closest_ancestor(self, path):
+        """Returns the closest folder containing path that has tags of its own, or None."""
+
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in self.own_tags:
+                return parent
+
+            path, parent = parent, os.path.dirname(parent)
+
+        return None
+
+    def get_tags(self, dirpath):
+        """Returns the set of effective tags for dirpath, even if it has no tags of its own."""
+
+        if dirpath in self.own_tags:
+            return self.effective.get_tags(dirpath)
+
+        return self.get_inherited_tags(dirpath)
+
+    def get_descendants(self, dirpath):
+        """Returns the sorted list of indexed folders inside dirpath, at any depth."""
+
+        prefix = os.path.join(dirpath, "")
+        start = end = bisect_left(self.dirpaths, prefix)
+        while end < len(self.dirpaths) and self.dirpaths[end].startswith(prefix):
+            end += 1
+
+        return self.dirpaths[start:end]
+
+    def query(self, mode, *tags):
+        """Returns the set of folder paths whose effective tags match 'tags' based on 'mode'."""
+
+        return self.effective.query(mode, *tags)
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    tag_index = TagIndex()
+
+    # index a couple of records
+    tag_index.add(r'C:\test_mdata_file.txt', "text", "important")
+    tag_index.add(r'C:\other_file.txt', "text")
+
+    # query the index
+    print tag_index.query(utils.FILTERMODE.ANY, "important", "non_existent_tag")
+    print tag_index.query(utils.FILTERMODE.ALL, "text", "important")
+
+    # remove a tag and query again
+    tag_index.remove(r'C:\test_mdata_file.txt', "important")
+    print tag_index.query(utils.FILTERMODE.ALL, "text", "important")
+
+    # bitmaps switch to the dense representation when it takes less memory
+    sparse = Bitmap(range(0, 1000000, 1000))
+    dense = Bitmap(range(0, 1000000, 3))
+    print "sparse: {} ids as {}".format(len(sparse), "bitmap" if sparse.bits is not None else "array")
+    print "dense: {} ids as {}".format(len(dense), "bitmap" if dense.bits is not None else "array")
+    print "intersection: {} ids".format(len(sparse & dense))
+
+    # tags can be completed and misspelled ones corrected
+    print TAGS.complete("imp"), TAGS.suggest("tetx"), TAGS.suggest("importnt")
+
+    # lookups don't depend on the vocabulary size
+    import random
+    import string
+    import timeit
+
+    random.seed(0)
+    vocabulary = TagDictionary()
+    for _ in xrange(50000):
+        vocabulary.get_id("".join(random.choice(string.ascii_lowercase + string.digits + "_") for _ in xrange(random.randint(4, 12))))
+    vocabulary.complete("")
+
+    word = vocabulary.names[1234]
+    misspelled = word[:2] + word[3:]
+    runs = 1000
+    print "50000 tags: complete '{}' {:.3f}ms, suggest '{}' -> {} {:.3f}ms".format(word[:3], timeit.timeit(lambda: vocabulary.complete(word[:3]), number=runs),
+                                                                                 misspelled, vocabulary.suggest(misspelled),
+                                                                                 timeit.timeit(lambda: vocabulary.suggest(misspelled), number=runs))
+
+    # attribute values are kept sorted, range queries cost two bisections plus the size of the result
+    tag_index.set_attributes(r'C:\test_mdata_file.txt', [("size", 2048)])
+    tag_index.set_attributes(r'C:\other_file.txt', [("size", 512)])
+    print tag_index.resolve(tag_index.get_range("size", 1024, None)), tag_index.count_range("size", None, 1024)
+
+    # folders inherit the tags of their ancestors
+    inherited_index = InheritedTagIndex()
+    inherited_index.set_tags(os.path.join("C:", "photos", "2023"), ["2023"])
+    inherited_index.set_tags(os.path.join("C:", "photos"), ["photo"])
+    print inherited_index.query(utils.FILTERMODE.ALL, "photo", "2023")
+    print inherited_index.get_tags(os.path.join("C:", "photos", "2023", "summer"))
@@ -0,0 +1,190 @@
+"""
+This module contains the Journal class, an append-only log of tag modifications used to
+make every tag operation durable without rewriting the metadata store.
+
+Each entry is a json list [mode, path, tags], encrypted with the provided function and
+base64-encoded so that it fits into a single line. Entries are flushed to the OS as soon as
+they're appended, and fsync-ed to disk in batches. The batch size and age are only checked when
+entries are appended, so the owner of the journal calls sync_if_due while idle to bound the age.
+
+e.g.
+
+import journal
+
+tag_journal = journal.Journal(r'C:\Program Files\FileManager\file_manager.journal', security.xor_key)
+
+# log a tag modification
+tag_journal.append(utils.TAGMODE.ADD, r'C:\test_mdata_file.txt', ["text", "important"])
+
+# while idle, fsync the entries appended more than a second ago
+tag_journal.sync_if_due()
+
+# on the next startup, re-apply the logged modifications
+for mode, path, tags in tag_journal.replay():
+    print mode, path, tags
+
+# once the modifications are saved into the metadata store, the journal can be emptied
+tag_journal.truncate()
+
+Classes:
+    Journal
+"""
+
+import base64
+import binascii
+import json
+import logging as log
+import os
+import time
+
+try:
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve the utils module
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import utils
+
+class Journal(object):
+    """Append-only log of tag modifications."""
+
+    def __init__(self, path, encrypt, sync_every=64, sync_interval=1.0):
+        """Open the journal at 'path'. 'encrypt' is a symmetric function used to encrypt and decrypt the entries.
+        The journal is fsync-ed every 'sync_every' entries or 'sync_interval' seconds, whichever comes first.
+        Both are checked when entries are appended, and the interval by sync_if_due."""
+
+        self.path = path
+        self.encrypt = encrypt
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        utils.make_dirs_if_not_existent(os.path.dirname(path))
+
+        self.journal_file = open(path, "a")
+        self.entries = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def __len__(self):
+        """Returns the number of entries in the journal."""
+
+        return self.entries
+
+    def append(self, mode, path, tags):
+        """Log a tag modification."""
+
+        return self.extend(mode, [path], tags)
+
+    def extend(self, mode, paths, tags):
+        """Log the same tag modification for all the paths, with a single write."""
+
+        tags = list(tags)
+        entries = "".join(base64.b64encode(self.encrypt(json.dumps([mode, path, tags]))) + "\n" for path in paths)
+
+        try:
+            self.journal_file.write(entries)
+            self.journal_file.flush()
+        except IOError as e:
+            log.error("Couldn't write to journal at <{}> because {}".format(self.path, e))
+            return False
+
+        self.entries += len(paths)
+        self.unsynced += len(paths)
+
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            return self.sync()
+
+        return True
+
+    def sync_if_due(self):
+        """Force the logged entries to disk if the last sync is older than sync_interval. Called while idle,
+        as the interval is otherwise only checked when new entries are appended."""
+
+        if self.unsynced and time.time() - self.last_sync >= self.sync_interval:
+            return self.sync()
+
+        return True
+
+    def sync(self):
+        """Force the logged entries to disk."""
+
+        if not self.unsynced:
+            return True
+
+        try:
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+        except (IOError, OSError) as e:
+            log.error("Couldn't sync journal at <{}> because {}".format(self.path, e))
+            return False
+
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        return True
+
+    def replay(self):
+        """Returns the list of (mode, path, tags) entries logged in the journal."""
+
+        entries = []
+
+        with open(self.path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    mode, path, tags = utils.json_loads(self.encrypt(base64.b64decode(line.strip())))
+                except (ValueError, TypeError, binascii.Error) as e:
+                    # a partially written entry, e.g. after a crash
+                    log.error("Skipping invalid journal entry in <{}> - {}".format(self.path, e))
+                    continue
+
+                entries.append((mode, path, tags))
+
+        self.entries = len(entries)
+
+        return entries
+
+    def truncate(self):
+        """Empty the journal, once all the logged modifications are saved."""
+
+        try:
+            self.journal_file.close()
+            open(self.path, "w").close()
+            self.journal_file = open(self.path, "a")
+        except IOError as e:
+            log.error("Couldn't truncate journal at <{}> because {}".format(self.path, e))
+            return False
+
+        self.entries = 0
+        self.unsynced = 0
+
+        return True
+
+    def close(self):
+        """Sync and close the journal."""
+
+        self.sync()
+        self.journal_file.close()
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    import tempfile
+
+    # example journal path, with a dummy encryption function
+    journal_path = os.path.join(tempfile.mkdtemp(), "file_manager.journal")
+    tag_journal = Journal(journal_path, lambda s: s[::-1])
+
+    # log some tag modifications
+    tag_journal.append(utils.TAGMODE.ADD, r'C:\test_mdata_file.txt', ["text", "important"])
+    tag_journal.append(utils.TAGMODE.REMOVE, r'C:\test_mdata_file.txt', ["important"])
+    tag_journal.extend(utils.TAGMODE.ADD, [r'C:\photo_1.jpg', r'C:\photo_2.jpg'], ["photo"])
+    tag_journal.close()
+
+    # read them back
+    tag_journal = Journal(journal_path, lambda s: s[::-1])
+    for mode, path, tags in tag_journal.replay():
+        print utils.TAGMODE.get_name(mode), path, tags
+
+    tag_journal.truncate()
+    print "entries after truncate: {}".format(len(tag_journal))
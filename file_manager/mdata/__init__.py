@@ -9,51 +9,104 @@ import json
 import logging as log
 import math
 import os
+import time
 from datetime import datetime
 
 try:
+    import index
     import utils
     import security
 except ImportError:
     import sys
-    # append the parent folder path to sys.path to retrieve utils and security modules
+    # append the parent folder path to sys.path to retrieve index, utils and security modules
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+    import index
     import utils
     import security
 
+STORE = None
+
+# stat data older than STAT_MAX_AGE seconds is refreshed on access (None to only refresh it on demand)
+STAT_MAX_AGE = None
+
+# names of the stat values of files kept in the range indexes of the TagIndex, see get_stat_values
+STAT_ATTRIBUTES = ("modified", "created", "size")
+
+def set_store_hook(store):
+    """Saves a reference to the record store to use instead of .mdata files (None to use .mdata files)."""
+
+    global STORE
+    STORE = store
+
+def set_stat_max_age(max_age):
+    """Set the age in seconds after which the stat data of a file is refreshed on access (None to only refresh it on demand)."""
+
+    global STAT_MAX_AGE
+    STAT_MAX_AGE = max_age
+
+def get_stat_values(stat_result):
+    """Returns the (m_time, c_time, size) tuple of a stat result, the values of STAT_ATTRIBUTES."""
+
+    return (stat_result.st_mtime, stat_result.st_ctime, stat_result.st_size)
+
 class MData(object):
     """Class representing arbitrary metadata associated with a file."""
 
-    fpath = None
-    fname = None
-    m_time = None
-    c_time = None
-    size = None
-    data = {}
-    save_path = None
-
-    def __init__(self, fpath, ftype=utils.FTYPE.FILE, autoload=True):
-        """Initializa and load a .mdata file."""
+    # a record is kept in memory for every file in the database: slots avoid a __dict__ per record.
+    # The file path is the only per-record string, shared with file_records and the tag index keys,
+    # while the file name is derived from it and the tags are stored as a tuple of index.TAGS ids
+    __slots__ = ("fpath", "tag_ids", "extra", "stat_info", "save_path", "index", "kind", "is_dirty")
+
+    def __init__(self, fpath, ftype=utils.FTYPE.FILE, autoload=True, index=None, name_maps=None, data=None, stat_result=None):
+        """Initializa and load a .mdata file. If provided, 'index' is kept in sync with this file tags.
+        'name_maps' is an optional { folder : name_map } cache shared by the .mdata files of a folder,
+        see generate_fpath. 'data' is the already decoded content of the record, which is then not read again.
+        'stat_result' is the already available stat of the file (e.g. DirEntry.stat()), otherwise the file
+        is only stat'ed when its times or size are first needed."""
+
+        self.fpath = None
+        self.index = index
+        self.tag_ids = ()
+        # data other than the tags and the file name, None if there is none
+        self.extra = None
+        self.save_path = None
+        # True when the tags were modified since the last save or load
+        self.is_dirty = False
+        # records loaded from .mdata files are file records as well
+        self.kind = utils.FTYPE.DIR if ftype == utils.FTYPE.DIR else utils.FTYPE.FILE
+        # (m_time, c_time, size, time of the stat), None until needed
+        self.stat_info = None
 
         if ftype == utils.FTYPE.MDATA:
-            # if loading from a .mdata file, retrieve the actual path
-            self.fpath = self.generate_fpath(fpath)
+            # if loading from a .mdata file, read it and retrieve the actual path
+            self.save_path = fpath
+            if data is None:
+                data = self.read_file(fpath)
+
+            if data is not None:
+                self.data = data
+                self.fpath = self.generate_fpath(fpath, name_maps, data.get("fname"))
+            else:
+                self.fpath = self.generate_fpath(fpath, name_maps)
+
+            self.update_index()
         else:
             # if creating .mdata from an actual file, just store the fpath
             self.fpath = fpath
 
-        if not fpath:
-            log.error("Unable to initialize .mdata file for <{}>".format(self.fpath))
+            if data is not None:
+                self.data = data
+                self.update_index()
 
-        self.fname = os.path.basename(self.fpath).partition(".")[0]
+        if not self.fpath:
+            log.error("Unable to initialize .mdata file for <{}>".format(fpath))
+            return
 
-        self.m_time = None
-        self.c_time = None
-        self.size = None
+        if stat_result is not None:
+            self.get_common_mdata(stat_result)
 
-        self.get_common_mdata()
-        if autoload:
+        if autoload and ftype != utils.FTYPE.MDATA:
             self.load()
 
     def __str__(self):
@@ -61,18 +114,69 @@ class MData(object):
 
     @property
     def is_valid(self):
-        """Perform checks to verify that the file is still valid."""
+        """Perform checks to verify that the file is still valid, based on the last stat data."""
 
-        return os.path.exists(self.fpath)
+        return self.get_stat_info()[0] is not None
+
+    @property
+    def m_time(self):
+        """Returns the last modification time of the file, None if it doesn't exist."""
+
+        return self.get_stat_info()[0]
+
+    @property
+    def c_time(self):
+        """Returns the creation time of the file (metadata change time on Unix), None if it doesn't exist."""
+
+        return self.get_stat_info()[1]
+
+    @property
+    def size(self):
+        """Returns the size in bytes of the file, None if it doesn't exist."""
+
+        return self.get_stat_info()[2]
+
+    @property
+    def is_stat_stale(self):
+        """Returns True if the stat data was never captured or is older than STAT_MAX_AGE."""
+
+        return self.stat_info is None or (STAT_MAX_AGE is not None and time.time() - self.stat_info[3] > STAT_MAX_AGE)
+
+    @property
+    def fname(self):
+        """Returns the name of the file, with extension."""
+
+        return os.path.basename(self.fpath) if self.fpath else None
 
     @property
     def tags(self):
         """Returns the tag associated with this file."""
 
-        try:
-            return self.data["tags"]
-        except KeyError:
-            return []
+        return [index.TAGS.get_name(tag_id) for tag_id in self.tag_ids]
+
+    @property
+    def data(self):
+        """Returns a dict with the metadata of this file, as it is saved to disk."""
+
+        data = dict(self.extra) if self.extra else {}
+        data["tags"] = self.tags
+        if self.fpath:
+            # store the actual file name, so that the file path can be rebuilt without scanning its folder
+            data["fname"] = self.fname
+
+        return data
+
+    @data.setter
+    def data(self, data):
+        """Replace the metadata of this file with the content of the 'data' dict."""
+
+        extra = dict(data)
+        tags = extra.pop("tags", ())
+        # the file name is derived from fpath
+        extra.pop("fname", None)
+
+        self.tag_ids = self.get_tag_ids(tags)
+        self.extra = extra or None
 
     @property
     def creation_time(self):
@@ -104,19 +208,35 @@ class MData(object):
         return "{:.2f} {}(s)".format(self.size / math.pow(1024, unit), utils.FILESIZE.get_name(unit).capitalize())
 
     def is_file_mdata(self, fname):
-        """"Returns True if this .mdata file is associated with the fname"""
+        """"Returns True if this .mdata file is associated with the fname (file name with extension)"""
 
         return self.fname == fname
 
-    def get_common_mdata(self):
-        """Extract common data from the associated file object."""
+    def get_stat_info(self):
+        """Returns the (m_time, c_time, size, stat time) tuple for the file, stat'ing it only if the data is stale."""
 
-        if not self.is_valid:
-            return
-        
-        self.m_time = os.path.getmtime(self.fpath)
-        self.c_time = os.path.getctime(self.fpath)
-        self.size = os.path.getsize(self.fpath)
+        if self.is_stat_stale:
+            self.get_common_mdata()
+
+        return self.stat_info
+
+    def get_common_mdata(self, stat_result=None):
+        """Extract common data from the associated file object with a single stat, or from 'stat_result' if provided."""
+
+        if stat_result is None:
+            try:
+                stat_result = os.stat(self.fpath)
+            except (OSError, TypeError):
+                stat_result = None
+
+        if stat_result is not None:
+            self.stat_info = get_stat_values(stat_result) + (time.time(),)
+        else:
+            self.stat_info = (None, None, None, time.time())
+
+        # keep the range indexes of the file up to date
+        if self.index is not None and self.kind == utils.FTYPE.FILE:
+            self.index.set_attributes(self.fpath, zip(STAT_ATTRIBUTES, self.stat_info))
 
     def tag(self, mode, *tags):
         """Modify tags for this .mdata file based on 'mode'."""
@@ -128,41 +248,59 @@ class MData(object):
         else:
             log.error("Invalid mode! {}. Please provide one between utils.TAGMODE.ADD and utils.TAGMODE.REMOVE".format(mode))
 
+    @staticmethod
+    def get_tag_ids(tags):
+        """Returns the tuple of index.TAGS ids for tags, without repetitions."""
+
+        tag_ids = []
+        for t in tags:
+            tag_id = index.TAGS.get_id(t)
+            if tag_id not in tag_ids:
+                tag_ids.append(tag_id)
+
+        return tuple(tag_ids)
+
     def add_tags(self, *tags):
         """Adds a list of tags to this mdata. Redundant tags won't be added again."""
 
-        try:
-            tag_list = self.data["tags"]
-        except KeyError:
-            tag_list = []
+        new_ids = tuple(tag_id for tag_id in self.get_tag_ids(tags) if tag_id not in self.tag_ids)
+        if not new_ids:
+            return
 
-        tag_list.extend(tags)
-        
-        self.data["tags"] = list(set(tag_list))
+        self.tag_ids += new_ids
+        self.is_dirty = True
+
+        if self.index is not None:
+            self.index.add(self.fpath, *tags)
 
     def remove_tags(self, *tags):
         """Removes a list of tags from this mdata."""
 
-        try:
-            tag_list = self.data["tags"]
-        except KeyError:
+        removed = set(index.TAGS.get_id(t, create=False) for t in tags)
+        tag_ids = tuple(tag_id for tag_id in self.tag_ids if tag_id not in removed)
+        if len(tag_ids) == len(self.tag_ids):
             return
 
-        self.data["tags"] = [t for t in tag_list if t not in tags]
+        self.tag_ids = tag_ids
+        self.is_dirty = True
+
+        if self.index is not None:
+            self.index.remove(self.fpath, *tags)
 
     def filter(self, mode, *tags):
         """Returns True if the mdata tags match the provided tags, based on 'mode'."""
 
-        try:
-            # compute intersection between this mdata taglist and the filter tags
-            intersection = len(set.intersection(set(self.data["tags"]), set(tags)))
-        except KeyError:
+        if not self.tag_ids:
             return False
-            
+
+        # compute intersection between this mdata tag ids and the filter tags ids (None for unknown tags)
+        filter_ids = set(index.TAGS.get_id(t, create=False) for t in tags)
+        intersection = len(filter_ids.intersection(self.tag_ids))
+
         if mode == utils.FILTERMODE.ANY:
             return intersection > 0
         elif mode == utils.FILTERMODE.ALL:
-            return intersection == len(tags)
+            return intersection == len(filter_ids)
         else:
             log.error("Invalid filter mode specified! ({}) Please provide a value from utils.FILTERMODE enum".format(mode))
             return False
@@ -175,6 +313,13 @@ class MData(object):
     def save(self):
         """Save this mdata to disk."""
 
+        if STORE is not None:
+            if not STORE.save_record(self.fpath, self.kind, security.xor_key(self.serialize())):
+                return False
+
+            self.is_dirty = False
+            return True
+
         # generate the .mdata file path
         if not self.save_path:
             mdata_path = self.generate_mdata_filepath()
@@ -189,28 +334,59 @@ class MData(object):
                 log.error("Couldn't write metadata at <{}> because {}".format(mdata_path, e))
                 return False
 
+        self.is_dirty = False
         return True
 
     def load(self):
         """Load a .mdata file from disk."""
 
+        if STORE is not None:
+            data = STORE.load_record(self.fpath)
+            if data is None:
+                return False
+
+            self.load_record(data)
+            return True
+
         # generate the .mdata file path
         if not self.save_path:
             mdata_path = self.generate_mdata_filepath()
         else:
             mdata_path = self.save_path
 
-        if not os.path.exists(mdata_path):
+        return self.load_file(mdata_path)
+
+    def load_record(self, record):
+        """Load this mdata from an encrypted record read from STORE."""
+
+        self.deserialize(security.xor_key(record))
+
+    def load_file(self, mdata_path):
+        """Load the .mdata file at mdata_path from disk."""
+
+        data = self.read_file(mdata_path)
+        if data is None:
             return False
 
-        # load .mdata file from disk
+        self.data = data
+        self.is_dirty = False
+        self.update_index()
+
+        return True
+
+    def read_file(self, mdata_path):
+        """Returns the data dict decoded from the .mdata file at mdata_path, or None if it can't be read."""
+
+        if not os.path.exists(mdata_path):
+            return None
+
+        # read .mdata file from disk
         with open(mdata_path, "r") as mdata_file:
             try:
-                self.deserialize(security.xor_key(mdata_file.read()))
-                return True
+                return self.decode(security.xor_key(mdata_file.read()))
             except IOError as e:
                 log.error("Couldn't read metadata at <{}> because {}".format(mdata_path, e))
-                return False
+                return None
 
     def serialize(self):
         """Returns a json string containing this object metadata for serialization."""
@@ -225,20 +401,39 @@ class MData(object):
 
     def deserialize(self, data):
         """Loads a json string into the data section of this MData class."""
-        
+
+        data = self.decode(data)
+        if data is None:
+            return
+
+        self.data = data
+        self.is_dirty = False
+
+        self.update_index()
+
+    def decode(self, data):
+        """Returns the data dict parsed from a json string, or None if it's invalid."""
+
         try:
-            self.data = utils.json_decode(json.loads(data))
+            return utils.json_loads(data)
         except ValueError as v_error:
             log.error("Metadata deserialization failed for <{}> - {}".format(
                 self.fpath, v_error))
+            return None
+
+    def update_index(self):
+        """Replace the tags indexed for this file with the current ones."""
+
+        if self.index is not None and self.fpath:
+            self.index.set_tags(self.fpath, self.tags)
 
     def generate_mdata_filepath(self):
         """Generate the appropriate .mdata filepath based on the assigned fpath."""
 
-        # generate .mdata file name and folder
-        mdata_name = os.path.basename(self.fpath).rpartition(".")[0]
-        mdata_folder_name = os.path.basename(os.path.dirname(self.fpath))
-        mdata_path = os.path.join(os.path.dirname(self.fpath), "{}_mdata".format(mdata_folder_name))
+        # generate .mdata file name and folder: the name keeps the file extension, so that files
+        # with the same name and different extensions don't share the same .mdata file
+        mdata_name = os.path.basename(self.fpath)
+        mdata_path = self.get_mdata_folder(os.path.dirname(self.fpath))
         
         # generate .mdata folder if not existent
         utils.make_dirs_if_not_existent(mdata_path)
@@ -246,27 +441,76 @@ class MData(object):
         # generate and return proper .mdata file path
         return os.path.join(mdata_path, "{}.mdata".format(mdata_name))
 
-    def generate_fpath(self, mdata_path):
-        """Generate a proper fpath from a .mdata file path."""
+    def generate_fpath(self, mdata_path, name_maps=None, fname=None):
+        """Generate a proper fpath from a .mdata file path. 'fname' is the file name stored in the .mdata file, if any."""
 
-        # generate file name and folder
-        fname = os.path.basename(mdata_path).rpartition(".")[0]
+        # generate file folder
         folder_name = os.path.dirname(os.path.dirname(mdata_path))
-        ftype = None
-
-        # retrieve extension by scanning files in mdata_path parent folder
-        for _, _, files in os.walk(folder_name):
-            for f in files:
-                if f.rpartition(".")[0] == fname:
-                    ftype = f.rpartition(".")[2]
-                    break
-            break
-
-        if ftype is None:
-            log.error("No file existent for .mdata file at <{}>".format(self.fpath))
+
+        # the actual file name is stored in the .mdata file
+        if fname:
+            return os.path.join(folder_name, fname)
+
+        # .mdata files saved before the file name was stored only have the name without
+        # extension: retrieve it from a listing of the parent folder, read once per folder
+        if name_maps is None:
+            name_maps = {}
+
+        try:
+            name_map = name_maps[folder_name]
+        except KeyError:
+            name_map = name_maps[folder_name] = generate_name_map(folder_name)
+
+        fname = os.path.basename(mdata_path).rpartition(".")[0]
+
+        try:
+            return os.path.join(folder_name, name_map[fname])
+        except KeyError:
+            log.error("No file existent for .mdata file at <{}>".format(mdata_path))
             return None
 
-        return os.path.join(folder_name, "{}.{}".format(fname, ftype))
+    @staticmethod
+    def get_mdata_folder(dirpath):
+        """Returns the folder containing the .mdata files for the files inside dirpath."""
+
+        return os.path.join(dirpath, "{}_mdata".format(os.path.basename(dirpath)))
+
+def decode_records(args):
+    """Decrypt and parse a list of records with the provided key. 'args' is a (key, records) tuple, so that this
+    function can be used with multiprocessing pools. Returns the list of data dicts, with None for invalid records."""
+
+    key, records = args
+
+    decoded = []
+    for record in records:
+        if record is None:
+            decoded.append(None)
+            continue
+
+        try:
+            decoded.append(utils.json_loads(security.xor_string(record, key)))
+        except ValueError as v_error:
+            log.error("Metadata deserialization failed - {}".format(v_error))
+            decoded.append(None)
+
+    return decoded
+
+def generate_name_map(folder_name):
+    """Returns a dict { file name without extension : file name } for the files inside folder_name."""
+
+    name_map = {}
+
+    try:
+        fnames = os.listdir(folder_name)
+    except OSError as e:
+        log.error("Unable to list files in <{}> because {}".format(folder_name, e))
+        return name_map
+
+    for f in fnames:
+        # keep the first match, as the previous extension scan did
+        name_map.setdefault(f.rpartition(".")[0], f)
+
+    return name_map
 
 if __name__ == "__main__":
     """Example usage for this module."""
@@ -297,3 +541,64 @@ if __name__ == "__main__":
 
     # save the modified metadata to disk
     mdata.save()
+
+    # compare the memory used by a tagged file record with the previous representation: a regular
+    # object with a __dict__, holding a data dict with the tag strings decoded from json for each file
+    import sys
+
+    class DictMData(object):
+        pass
+
+    def get_deep_size(obj, seen):
+        """Returns the size in bytes of obj and the objects it references, skipping the ones in seen."""
+
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum(get_deep_size(k, seen) + get_deep_size(v, seen) for k, v in obj.iteritems())
+        elif isinstance(obj, (list, tuple)):
+            size += sum(get_deep_size(element, seen) for element in obj)
+        elif hasattr(obj, "__dict__"):
+            size += get_deep_size(obj.__dict__, seen)
+        elif hasattr(obj, "__slots__"):
+            size += sum(get_deep_size(getattr(obj, slot), seen) for slot in obj.__slots__)
+
+        return size
+
+    records_count = 10000
+    records = [(r'C:\photos\{}\img_{:05d}.jpg'.format(i / 100, i),
+                '{{"fname": "img_{:05d}.jpg", "tags": ["photo", "{}", "camera"]}}'.format(i, 2000 + i % 20))
+                for i in xrange(records_count)]
+
+    # shared objects (interned tags, enum values, the index) are only counted once
+    seen = set([id(utils.FTYPE.FILE), id(None), id(False)])
+
+    dict_records = []
+    for path, record in records:
+        md = DictMData()
+        md.index = None
+        md.data = utils.json_loads(record)
+        md.is_dirty = False
+        md.kind = utils.FTYPE.FILE
+        md.fpath = path
+        md.fname = os.path.basename(path)
+        md.m_time, md.c_time, md.size = 1500000000.0 + len(dict_records), 1500000000.0, 4096 + len(dict_records)
+        dict_records.append(md)
+
+    dict_size = sum(get_deep_size(md, seen) for md in dict_records)
+
+    slots_records = []
+    for path, record in records:
+        md = MData(path, autoload=False, data=utils.json_loads(record))
+        md.stat_info = (1500000000.0 + len(slots_records), 1500000000.0, 4096 + len(slots_records), 1500000000.0)
+        slots_records.append(md)
+
+    seen.update(id(t) for t in index.TAGS.names)
+    seen.update(id(tag_id) for tag_id in index.TAGS.ids.itervalues())
+    slots_size = sum(get_deep_size(md, seen) for md in slots_records)
+
+    print "bytes per tagged file: {} with a __dict__, {} with __slots__ ({:.1f}x smaller)".format(
+        dict_size / records_count, slots_size / records_count, float(dict_size) / slots_size)
@@ -0,0 +1,474 @@
+"""
+This module contains a small boolean query language over tags, and a planner executing the
+queries against a TagIndex.
+
+Queries combine tags with AND, OR, NOT and parentheses. Adjacent terms are implicitly joined
+with AND, and tags containing spaces or keywords can be double-quoted. A tag ending with '*'
+(e.g. 'proj*') matches any tag starting with the rest.
+
+Range predicates on the files size, modification and creation time (e.g. 'size>100MB',
+'modified<2023-01-01', 'created>=2023-06-01T12:00') are answered by the sorted attribute
+indexes of the TagIndex, and can be combined with tags.
+
+e.g.
+
+import query
+
+plan = query.compile_query('(photo AND 2023) AND NOT raw AND size>10MB', tag_index)
+
+# print the plan with the estimated cardinality of each step
+print plan.explain()
+
+# returns the set of records matching the query
+print plan.execute(tag_index)
+
+Classes:
+    Plan
+    Query
+
+Variables:
+    Tag
+    And
+    Or
+    Not
+    Range
+    All
+    Prefix
+"""
+
+import logging as log
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+try:
+    import index
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve index and utils modules
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import index
+    import utils
+
+# query syntax tree nodes
+Tag = namedtuple("Tag", ["name"])
+And = namedtuple("And", ["children"])
+Or = namedtuple("Or", ["children"])
+Not = namedtuple("Not", ["child"])
+# records whose attribute value is in the range [low, high) (None for an unbounded side)
+Range = namedtuple("Range", ["text", "attribute", "low", "high"])
+# every record
+All = namedtuple("All", [])
+# records with any tag starting with prefix
+Prefix = namedtuple("Prefix", ["prefix"])
+
+KEYWORDS = ("AND", "OR", "NOT")
+TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+RANGE_RE = re.compile(r'^(size|modified|created)(<=|>=|<|>|=)(.+)$', re.IGNORECASE)
+SIZE_RE = re.compile(r'^(\d+(?:\.\d*)?)([KMGT]?)B?$', re.IGNORECASE)
+
+# size suffix -> utils.FILESIZE unit
+SIZE_UNITS = {"": utils.FILESIZE.BYTE, "K": utils.FILESIZE.KILOBYTE, "M": utils.FILESIZE.MEGABYTE,
+              "G": utils.FILESIZE.GIGABYTE, "T": utils.FILESIZE.TERABYTE}
+# accepted date formats, with the length of the period they denote
+DATE_FORMATS = (("%Y-%m-%d", timedelta(days=1)), ("%Y-%m-%dT%H:%M", timedelta(minutes=1)), ("%Y-%m-%dT%H:%M:%S", timedelta(seconds=1)))
+
+def tokenize(expression):
+    """Returns a list of (kind, value) tokens for 'expression', where kind is one of '(', ')', 'KEYWORD', 'TAG', 'RANGE', 'PREFIX'."""
+
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise ValueError("Unexpected character at position {}: '{}'".format(position, expression[position:]))
+
+        open_paren, close_paren, quoted, word = match.groups()
+        if open_paren:
+            tokens.append(("(", open_paren))
+        elif close_paren:
+            tokens.append((")", close_paren))
+        elif quoted is not None:
+            tokens.append(("TAG", quoted))
+        elif word.upper() in KEYWORDS:
+            tokens.append(("KEYWORD", word.upper()))
+        elif RANGE_RE.match(word):
+            tokens.append(("RANGE", word))
+        elif is_prefix(word):
+            tokens.append(("PREFIX", word[:-1]))
+        else:
+            tokens.append(("TAG", word))
+
+        position = match.end()
+
+    return tokens
+
+class Query(object):
+    """Recursive descent parser turning a query string into a syntax tree of Tag, And, Or and Not nodes."""
+
+    def __init__(self, expression):
+        """Parse 'expression'. Raises ValueError if the expression is invalid."""
+
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+        if not self.tokens:
+            raise ValueError("Empty query")
+
+        self.tree = self.parse_or()
+
+        if self.position < len(self.tokens):
+            raise ValueError("Unexpected '{}' in query '{}'".format(self.tokens[self.position][1], expression))
+
+    def peek(self):
+        """Returns the current token, or (None, None) at the end of the query."""
+
+        try:
+            return self.tokens[self.position]
+        except IndexError:
+            return (None, None)
+
+    def parse_or(self):
+        """or_expr := and_expr (OR and_expr)*"""
+
+        children = [self.parse_and()]
+        while self.peek() == ("KEYWORD", "OR"):
+            self.position += 1
+            children.append(self.parse_and())
+
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and(self):
+        """and_expr := not_expr ([AND] not_expr)*"""
+
+        children = [self.parse_not()]
+        while True:
+            kind, value = self.peek()
+            if (kind, value) == ("KEYWORD", "AND"):
+                self.position += 1
+            elif kind not in ("TAG", "RANGE", "PREFIX", "(") and (kind, value) != ("KEYWORD", "NOT"):
+                break
+
+            children.append(self.parse_not())
+
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_not(self):
+        """not_expr := NOT not_expr | atom"""
+
+        if self.peek() == ("KEYWORD", "NOT"):
+            self.position += 1
+            return Not(self.parse_not())
+
+        return self.parse_atom()
+
+    def parse_atom(self):
+        """atom := TAG | RANGE | PREFIX | '(' or_expr ')'"""
+
+        kind, value = self.peek()
+        self.position += 1
+
+        if kind == "TAG":
+            return Tag(value)
+        elif kind == "RANGE":
+            return parse_range(value)
+        elif kind == "PREFIX":
+            return Prefix(value)
+        elif kind == "(":
+            node = self.parse_or()
+            if self.peek()[0] != ")":
+                raise ValueError("Missing ')' in query '{}'".format(self.expression))
+            self.position += 1
+            return node
+        elif kind is None:
+            raise ValueError("Unexpected end of query '{}'".format(self.expression))
+        else:
+            raise ValueError("Unexpected '{}' in query '{}'".format(value, self.expression))
+
+def is_prefix(tag):
+    """Returns True if tag is a prefix pattern like 'proj*'."""
+
+    return len(tag) > 1 and tag.endswith("*")
+
+def parse_range(text):
+    """Returns the Range node for a predicate like 'size>100MB' or 'modified<2023-01-01'. Raises ValueError if it's invalid."""
+
+    attribute, operator, value = RANGE_RE.match(text).groups()
+    attribute = attribute.lower()
+
+    # the value denotes the interval [start, end): a single byte for sizes, the whole day for dates without time
+    if attribute == "size":
+        match = SIZE_RE.match(value)
+        if not match:
+            raise ValueError("Invalid size '{}', e.g. 100MB".format(value))
+
+        start = int(float(match.group(1)) * 1024 ** SIZE_UNITS[match.group(2).upper()])
+        end = start + 1
+    else:
+        for date_format, period in DATE_FORMATS:
+            try:
+                date = datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError("Invalid date '{}', e.g. 2023-01-01 or 2023-01-01T12:00".format(value))
+
+        start = time.mktime(date.timetuple())
+        end = time.mktime((date + period).timetuple())
+
+    if operator == "<":
+        return Range(text, attribute, None, start)
+    elif operator == "<=":
+        return Range(text, attribute, None, end)
+    elif operator == ">":
+        return Range(text, attribute, end, None)
+    elif operator == ">=":
+        return Range(text, attribute, start, None)
+
+    return Range(text, attribute, start, end)
+
+class Plan(object):
+    """A step of a query execution plan, with the estimated number of matching records."""
+
+    def __init__(self, op, estimate, children=(), tag=None, predicate=None):
+        """Initialize a plan step. 'op' is one of TAG, RANGE (a Range 'predicate'), AND, OR, NOT, ALL (every indexed record)."""
+
+        self.op = op
+        self.estimate = estimate
+        self.children = children
+        self.tag = tag
+        self.predicate = predicate
+
+    def explain(self, depth=0):
+        """Returns a human-readable description of the plan."""
+
+        if self.op == "TAG":
+            label = "{} '{}'".format(self.op, self.tag)
+        elif self.op == "RANGE":
+            label = "{} '{}'".format(self.op, self.predicate.text)
+        else:
+            label = self.op
+        lines = ["{}{} (est. {})".format("  " * depth, label, self.estimate)]
+        lines.extend(child.explain(depth + 1) for child in self.children)
+
+        return "\n".join(lines)
+
+    def execute(self, tag_index):
+        """Returns the set of record ids in tag_index matching this plan."""
+
+        return tag_index.resolve(self.evaluate(tag_index))
+
+    def evaluate(self, tag_index):
+        """Returns the Bitmap of the dense record ids in tag_index matching this plan."""
+
+        if self.op == "TAG":
+            return tag_index.get_posting(self.tag)
+        elif self.op == "RANGE":
+            return tag_index.get_range(self.predicate.attribute, self.predicate.low, self.predicate.high)
+        elif self.op == "ALL":
+            return tag_index.ids()
+        elif self.op == "OR":
+            return index.Bitmap.union(*[child.evaluate(tag_index) for child in self.children])
+        elif self.op == "NOT":
+            return tag_index.ids() - self.children[0].evaluate(tag_index)
+        elif self.op == "AND":
+            # children are sorted by selectivity, negated ones last: start from the smallest
+            # posting list and stop as soon as the intersection is empty
+            result = None
+            for child in self.children:
+                if result is not None and not result:
+                    break
+
+                if child.op == "NOT":
+                    result = (tag_index.ids() if result is None else result) - child.children[0].evaluate(tag_index)
+                else:
+                    matching = child.evaluate(tag_index)
+                    result = matching if result is None else result & matching
+
+            return result if result is not None else index.Bitmap()
+
+        log.error("Invalid plan step {}".format(self.op))
+        return index.Bitmap()
+
+    def matches(self, tags, values):
+        """Returns True if a single record with 'tags' (a set of tag names) and attribute 'values'
+        (a dict { attribute : value }) matches this plan."""
+
+        if self.op == "TAG":
+            return self.tag in tags
+        elif self.op == "RANGE":
+            value = values.get(self.predicate.attribute)
+            return (value is not None and (self.predicate.low is None or value >= self.predicate.low)
+                    and (self.predicate.high is None or value < self.predicate.high))
+        elif self.op == "ALL":
+            return True
+        elif self.op == "OR":
+            return any(child.matches(tags, values) for child in self.children)
+        elif self.op == "NOT":
+            return not self.children[0].matches(tags, values)
+        elif self.op == "AND":
+            return all(child.matches(tags, values) for child in self.children)
+
+        log.error("Invalid plan step {}".format(self.op))
+        return False
+
+def plan_query(node, tag_index):
+    """Returns a Plan for the syntax tree 'node', ordering the operations by the posting list sizes in tag_index."""
+
+    total = len(tag_index)
+
+    if isinstance(node, Tag):
+        return Plan("TAG", tag_index.cardinality(node.name), tag=node.name)
+    elif isinstance(node, Range):
+        return Plan("RANGE", tag_index.count_range(node.attribute, node.low, node.high), predicate=node)
+    elif isinstance(node, All):
+        return Plan("ALL", total)
+    elif isinstance(node, Prefix):
+        # the union of the known tags starting with prefix, skipping the ones without records
+        children = [Plan("TAG", tag_index.cardinality(t), tag=t) for t in tag_index.tags.complete(node.prefix)]
+        children = sorted((c for c in children if c.estimate), key=lambda p: p.estimate)
+        return Plan("OR", min(sum(c.estimate for c in children), total), tuple(children))
+    elif isinstance(node, Not):
+        child = plan_query(node.child, tag_index)
+        return Plan("NOT", max(total - child.estimate, 0), (child,))
+    elif isinstance(node, Or):
+        children = sorted(_flatten(node, Or, tag_index), key=lambda p: p.estimate)
+        return Plan("OR", min(sum(c.estimate for c in children), total), tuple(children))
+    elif isinstance(node, And):
+        children = _flatten(node, And, tag_index)
+        positive = sorted((c for c in children if c.op != "NOT"), key=lambda p: p.estimate)
+        # negated children are applied last, removing the largest sets first
+        negated = sorted((c for c in children if c.op == "NOT"), key=lambda p: p.estimate)
+
+        if positive:
+            estimate = positive[0].estimate
+        else:
+            estimate = min(c.estimate for c in negated)
+
+        return Plan("AND", estimate, tuple(positive + negated))
+
+    raise ValueError("Invalid query node {}".format(node))
+
+def _flatten(node, node_type, tag_index):
+    """Returns the plans for the children of 'node', merging nested nodes of the same node_type."""
+
+    plans = []
+    for child in node.children:
+        if isinstance(child, node_type):
+            plans.extend(_flatten(child, node_type, tag_index))
+        else:
+            plans.append(plan_query(child, tag_index))
+
+    return plans
+
+def make_tags_query(mode, tags):
+    """Returns the syntax tree matching 'tags' based on 'mode' (a utils.FILTERMODE value), where tags can be
+    prefix patterns like 'proj*'. Returns None if mode is invalid."""
+
+    nodes = tuple(Prefix(t[:-1]) if is_prefix(t) else Tag(t) for t in tags)
+
+    if mode == utils.FILTERMODE.ANY:
+        return Or(nodes)
+    elif mode == utils.FILTERMODE.ALL:
+        return And(nodes)
+
+    log.error("Invalid filter mode specified! ({}) Please provide a value from utils.FILTERMODE enum".format(mode))
+    return None
+
+def get_tags(node):
+    """Returns the set of tags (not prefix patterns) used by the syntax tree 'node'."""
+
+    if isinstance(node, Tag):
+        return set([node.name])
+    elif isinstance(node, Not):
+        return get_tags(node.child)
+    elif isinstance(node, (And, Or)):
+        return set().union(*[get_tags(child) for child in node.children])
+
+    return set()
+
+def has_ranges(node):
+    """Returns True if the syntax tree 'node' contains range predicates."""
+
+    if isinstance(node, Range):
+        return True
+    elif isinstance(node, Not):
+        return has_ranges(node.child)
+    elif isinstance(node, (And, Or)):
+        return any(has_ranges(child) for child in node.children)
+
+    return False
+
+def relax_ranges(node):
+    """Returns the syntax tree 'node' with the range predicates, and the negations containing them, replaced by All:
+    the result matches every record that could match 'node' for some values of its attributes."""
+
+    if isinstance(node, Range) or (isinstance(node, Not) and has_ranges(node.child)):
+        return All()
+    elif isinstance(node, And):
+        return And(tuple(relax_ranges(child) for child in node.children))
+    elif isinstance(node, Or):
+        return Or(tuple(relax_ranges(child) for child in node.children))
+
+    return node
+
+def parse_query(expression):
+    """Returns the syntax tree for the query 'expression', or None if the expression is invalid."""
+
+    try:
+        return Query(expression).tree
+    except ValueError as v_error:
+        log.error("Invalid query '{}' - {}".format(expression, v_error))
+        return None
+
+def compile_query(expression, tag_index):
+    """Returns the Plan for the query 'expression' against tag_index, or None if the expression is invalid."""
+
+    tree = parse_query(expression)
+    if tree is None:
+        return None
+
+    return plan_query(tree, tag_index)
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    # build a small index
+    tag_index = index.TagIndex()
+    tag_index.add(r'C:\photo_2023.jpg', "photo", "2023")
+    tag_index.add(r'C:\photo_2023.raw', "photo", "2023", "raw")
+    tag_index.add(r'C:\photo_2022.jpg', "photo", "2022")
+    tag_index.add(r'C:\notes.txt', "text", "2023")
+
+    # compile, explain and run a query
+    plan = compile_query("(photo AND 2023) AND NOT raw", tag_index)
+    print plan.explain()
+    print plan.execute(tag_index)
+
+    # adjacent terms are joined with AND
+    print compile_query("photo (2022 OR text)", tag_index).execute(tag_index)
+    print compile_query("NOT photo", tag_index).execute(tag_index)
+
+    # range predicates use the sorted attribute indexes
+    tag_index.set_attributes(r'C:\photo_2023.jpg', [("size", 3 * 1024 ** 2), ("modified", time.mktime((2023, 5, 1, 0, 0, 0, 0, 0, -1)))])
+    tag_index.set_attributes(r'C:\photo_2023.raw', [("size", 25 * 1024 ** 2), ("modified", time.mktime((2023, 5, 1, 0, 0, 0, 0, 0, -1)))])
+    tag_index.set_attributes(r'C:\photo_2022.jpg', [("size", 2 * 1024 ** 2), ("modified", time.mktime((2022, 7, 1, 0, 0, 0, 0, 0, -1)))])
+
+    plan = compile_query("photo size>2MB modified>=2023-01-01", tag_index)
+    print plan.explain()
+    print plan.execute(tag_index)
+    print compile_query("photo AND NOT size<=3MB", tag_index).execute(tag_index)
+
+    # prefix patterns match any tag starting with the prefix
+    print compile_query("202* AND NOT raw", tag_index).explain()
+
+    # invalid queries are reported and return None
+    print compile_query("photo AND (2023", tag_index)
@@ -24,13 +24,32 @@ print "decrypted: {}".format(decrypted)
 
 """
 
+import binascii
+import logging as log
 import math
+import os
 import random
 import subprocess
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 CHARSET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%&'()*+,-./:;<=>?@[]^_`{|}~ "
 FMANAGER = None
 
+# { (lenght, seed) : key } cache of the keys generated by derive_key
+_key_cache = {}
+
+# environment variables overriding the hardware ID, either directly or with the path to a file containing it
+HARDWARE_ID_ENV = "FILE_MANAGER_HWID"
+HARDWARE_ID_FILE_ENV = "FILE_MANAGER_HWID_FILE"
+
+# the hardware ID is resolved once per process, by the first provider returning a value
+_hardware_id = None
+
 def set_manager_hook(file_manager):
     """Saves a reference to the file_manager.py."""
 
@@ -40,22 +59,114 @@ def set_manager_hook(file_manager):
 def generate_base_key(lenght, seed):
     """Generate a random password-like string of desired lenght."""
 
-    random.seed(seed)
-    key = "".join(random.choice(CHARSET) for i in range(lenght))
-    
-    # clear the used seed to prevent other callers to random module to re-use the same seed
-    random.seed()
+    # use a dedicated generator, so that the global random module state is left untouched
+    generator = random.Random(seed)
+    return "".join(generator.choice(CHARSET) for i in range(lenght))
+
+def derive_key(seed, lenght=1024):
+    """Returns the key generated from seed, generating it only the first time it's requested."""
+
+    try:
+        return _key_cache[(lenght, seed)]
+    except KeyError:
+        key = _key_cache[(lenght, seed)] = generate_base_key(lenght, seed)
+        return key
+
+def clear_key_cache():
+    """Forget all the keys generated by derive_key, e.g. after a password change."""
+
+    _key_cache.clear()
+
+def hardware_id_from_env():
+    """Returns the hardware ID set in the FILE_MANAGER_HWID environment variable."""
+
+    return os.environ.get(HARDWARE_ID_ENV)
+
+def hardware_id_from_file():
+    """Returns the hardware ID stored in the file pointed by the FILE_MANAGER_HWID_FILE environment variable."""
+
+    hid_path = os.environ.get(HARDWARE_ID_FILE_ENV)
+    if not hid_path:
+        return None
+
+    with open(hid_path, "r") as hid_file:
+        return hid_file.read().strip()
+
+def hardware_id_from_wmic():
+    """Returns the motherboard UUID on Windows."""
+
+    if not sys.platform.startswith("win"):
+        return None
+
+    return subprocess.check_output('wmic csproduct get uuid').split('\n')[1].strip()
+
+def hardware_id_from_machine_id():
+    """Returns the machine ID on Linux."""
+
+    for hid_path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+        if os.path.exists(hid_path):
+            with open(hid_path, "r") as hid_file:
+                return hid_file.read().strip()
+
+    return None
+
+# callables returning the hardware ID, or None if not available, in the order they are tried
+HARDWARE_ID_PROVIDERS = [hardware_id_from_env, hardware_id_from_file, hardware_id_from_wmic, hardware_id_from_machine_id]
+
+def register_hardware_id_provider(provider, index=0):
+    """Add a callable returning the hardware ID (or None) to HARDWARE_ID_PROVIDERS at 'index'.
+    By default it's tried before the other providers."""
 
-    return key
+    global _hardware_id
+
+    HARDWARE_ID_PROVIDERS.insert(index, provider)
+
+    # resolve the hardware ID again on the next request
+    _hardware_id = None
 
 def generate_hardware_id():
     """Returns a hardware-specific ID for the current machine."""
 
-    return subprocess.check_output('wmic csproduct get uuid').split('\n')[1].strip()
+    global _hardware_id
+
+    if _hardware_id is not None:
+        return _hardware_id
+
+    for provider in HARDWARE_ID_PROVIDERS:
+        try:
+            hid = provider()
+        except (IOError, OSError, subprocess.CalledProcessError, IndexError) as e:
+            log.error("Hardware ID provider {} failed - {}".format(provider.__name__, e))
+            continue
+
+        if hid:
+            _hardware_id = hid
+            return _hardware_id
+
+    log.error("Unable to retrieve a hardware ID for this machine. Set the {} environment variable to provide one.".format(HARDWARE_ID_ENV))
+    return ""
 
 def xor_string(string, key):
     """XOR a string with a provided key."""
 
+    if not string:
+        return ""
+
+    # adjust the key lenght to be the size of the string
+    key_min_len = int(math.ceil(float(len(string)) / float(len(key)))) 
+    key = (key * key_min_len)[:len(string)]
+
+    # xor the whole buffers at once
+    if numpy is not None:
+        return (numpy.frombuffer(string, dtype=numpy.uint8) ^ numpy.frombuffer(key, dtype=numpy.uint8)).tostring()
+
+    # without numpy, xor the buffers as two big integers
+    xored = int(binascii.hexlify(string), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify("%0*x" % (2 * len(string), xored))
+
+def xor_string_per_char(string, key):
+    """XOR a string with a provided key, one character at a time. Slower reference for xor_string."""
+
     # adjust the key lenght to be at least the size of the string
     key_min_len = int(math.ceil(float(len(string)) / float(len(key)))) 
 
@@ -65,22 +176,25 @@ def xor_string(string, key):
 def xor_hid(string):
     """XOR a string using an hardware ID-dependent key."""
 
-    return xor_string(string, generate_base_key(1024, generate_hardware_id()))
+    return xor_string(string, derive_key(generate_hardware_id()))
 
 def xor_key(string):
     """XOR the given string with a password key"""
 
+    return xor_string(string, get_key())
+
+def get_key():
+    """Returns the key used by xor_key: derived from the password if set, else from the hardware ID."""
+
     global FMANAGER
 
     if FMANAGER:
         try:
-            return xor_string(string, generate_base_key(1024, FMANAGER.config["pw"]))
+            return derive_key(FMANAGER.config["pw"])
         except KeyError:
             pass    
 
-    return xor_string(string, KEY)
-
-KEY = generate_base_key(1024, generate_hardware_id())
+    return derive_key(generate_hardware_id())
 
 if __name__ == "__main__":
     """Example usage for this module."""
@@ -108,3 +222,17 @@ if __name__ == "__main__":
     print "test using the same password as the key seed for a 256-chars password 30 times:"
     for i in range(30):
         print generate_base_key(256, "$up3r$Tr0ngPW!")
+
+    # check that xor_string is compatible with the per-character implementation, and compare their speed
+    import timeit
+
+    key = derive_key(generate_hardware_id())
+
+    for size in (0, 1, 1023, 1024, 1025, 100000):
+        payload = os.urandom(size)
+        assert xor_string(payload, key) == xor_string_per_char(payload, key)
+        assert xor_string(xor_string(payload, key), key) == payload
+
+    payload = os.urandom(1024 * 1024)
+    for f in (xor_string_per_char, xor_string):
+        print "{} on 1MB: {:.4f}s".format(f.__name__, min(timeit.repeat(lambda: f(payload, key), number=1, repeat=3)))
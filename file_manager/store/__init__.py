@@ -0,0 +1,145 @@
+"""
+This module contains the SQLiteStore class, a single-file storage backend holding the
+metadata of every tagged file and folder, as an alternative to one .mdata file per record.
+
+Records are stored already encrypted: the store only deals with opaque strings.
+
+e.g.
+
+import store
+
+record_store = store.SQLiteStore(r'C:\Program Files\FileManager\file_manager.sqlite')
+
+# save a record and make it durable
+record_store.save_record(r'C:\test_mdata_file.txt', utils.FTYPE.FILE, "encrypted data")
+record_store.commit()
+
+# load all the file records inside a folder with a single query
+print record_store.load_folder(r'C:\')
+
+record_store.close()
+
+Classes:
+    SQLiteStore
+"""
+
+import logging as log
+import os
+import sqlite3
+
+try:
+    import utils
+except ImportError:
+    import sys
+    # append the parent folder path to sys.path to retrieve the utils module
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import utils
+
+class SQLiteStore(object):
+    """Storage backend keeping all the metadata records into a single SQLite database."""
+
+    def __init__(self, db_path):
+        """Open (or create) the SQLite database at db_path."""
+
+        self.db_path = db_path
+
+        utils.make_dirs_if_not_existent(os.path.dirname(db_path))
+
+        self.connection = sqlite3.connect(db_path)
+        # records are already encrypted, don't try to decode them
+        self.connection.text_factory = str
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records ("
+                                "path TEXT PRIMARY KEY, "
+                                "dirpath TEXT NOT NULL, "
+                                "kind INTEGER NOT NULL, "
+                                "data BLOB NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS records_dirpath ON records (dirpath, kind)")
+        self.connection.commit()
+
+    def load_record(self, path):
+        """Returns the data stored for path, or None if there's no record for it."""
+
+        try:
+            row = self.connection.execute("SELECT data FROM records WHERE path = ?", (path,)).fetchone()
+        except sqlite3.Error as e:
+            log.error("Couldn't read record for <{}> from <{}> because {}".format(path, self.db_path, e))
+            return None
+
+        return str(row[0]) if row else None
+
+    def load_folder(self, dirpath, kind=utils.FTYPE.FILE):
+        """Returns a list of (path, data) tuples for all the records of type 'kind' inside dirpath."""
+
+        try:
+            rows = self.connection.execute("SELECT path, data FROM records WHERE dirpath = ? AND kind = ?", (dirpath, kind)).fetchall()
+        except sqlite3.Error as e:
+            log.error("Couldn't read records for <{}> from <{}> because {}".format(dirpath, self.db_path, e))
+            return []
+
+        return [(path, str(data)) for path, data in rows]
+
+    def save_record(self, path, kind, data):
+        """Insert or replace the record for path. Changes are written to disk on commit()."""
+
+        try:
+            self.connection.execute("INSERT OR REPLACE INTO records (path, dirpath, kind, data) VALUES (?, ?, ?, ?)",
+                                    (path, os.path.dirname(path), kind, sqlite3.Binary(data)))
+        except sqlite3.Error as e:
+            log.error("Couldn't write record for <{}> to <{}> because {}".format(path, self.db_path, e))
+            return False
+
+        return True
+
+    def delete_record(self, path):
+        """Delete the record for path. Changes are written to disk on commit()."""
+
+        try:
+            self.connection.execute("DELETE FROM records WHERE path = ?", (path,))
+        except sqlite3.Error as e:
+            log.error("Couldn't delete record for <{}> from <{}> because {}".format(path, self.db_path, e))
+            return False
+
+        return True
+
+    def commit(self):
+        """Write all pending changes to disk in a single transaction."""
+
+        try:
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.error("Couldn't commit changes to <{}> because {}".format(self.db_path, e))
+            return False
+
+        return True
+
+    def close(self):
+        """Commit pending changes and close the database."""
+
+        self.commit()
+        self.connection.close()
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    import tempfile
+
+    # example database path
+    db_path = os.path.join(tempfile.mkdtemp(), "file_manager.sqlite")
+
+    record_store = SQLiteStore(db_path)
+
+    # save some records in a single transaction
+    record_store.save_record(r'C:\test_mdata_file.txt', utils.FTYPE.FILE, "{ tags: [ 'text' ] }")
+    record_store.save_record(r'C:\test_mdata_file2.txt', utils.FTYPE.FILE, "{ tags: [ 'important' ] }")
+    record_store.save_record(r'C:\test_folder', utils.FTYPE.DIR, "{ tags: [ 'folder' ] }")
+    record_store.commit()
+
+    # load the file records inside the folder
+    print record_store.load_folder(os.path.dirname(r'C:\test_mdata_file.txt'))
+
+    # load a single record
+    print record_store.load_record(r'C:\test_folder')
+
+    record_store.close()
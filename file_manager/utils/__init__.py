@@ -16,6 +16,7 @@ Classes:
     FilterMode
     FMCoreFiles
     FType
+    Storage
     TagMode
 
 Variables:
@@ -23,6 +24,7 @@ Variables:
     FILTERMODE
     FMCOREFILES
     FTYPE
+    STORAGE
     TAGMODE
 """
 
@@ -32,6 +34,15 @@ import logging as log
 import json
 from uuid import UUID
 
+try:
+    from os import scandir
+except ImportError:
+    # python 2 only has scandir as a separate package
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 class BaseEnum(object):
     """ Base Class for enums. Should never be instantiated directly - instead subclass it into the desired Enum
     and just add the values as class variables
@@ -81,6 +92,13 @@ class FType(BaseEnum):
 
     FILE = 0
     MDATA = 1
+    DIR = 2
+
+class Storage(BaseEnum):
+    """Enum-like class to enumerate the storage backends for metadata records."""
+
+    FILES = 0
+    SQLITE = 1
 
 class TagMode(BaseEnum):
     """Enum-like class to enumerate tag modification modes."""
@@ -92,6 +110,7 @@ FILESIZE = FileSize()
 FILTERMODE = FilterMode()
 FMCOREFILES = FMCoreFiles()
 FTYPE = FType()
+STORAGE = Storage()
 TAGMODE = TagMode()
 
 class Encoder(json.JSONEncoder):
@@ -105,7 +124,7 @@ class Encoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 def json_decode(input):
-    """Handles string and uuid decoding."""
+    """Handles string and uuid decoding of an already parsed json object. Use json_loads to decode while parsing."""
 
     if isinstance(input, dict):
         return {json_decode(key) : json_decode(value)
@@ -121,12 +140,94 @@ def json_decode(input):
     else:
         return input
 
+def json_loads(data):
+    """Parse a json string, decoding strings to str and the UUID_FIELDS values to UUID objects while parsing."""
+
+    return _decode_value(JSON_DECODER.decode(data))
+
+def _decode_value(value):
+    """Decode a parsed json value: objects are already decoded by _decode_pairs, strings inside lists aren't."""
+
+    if value.__class__ is unicode:
+        return value.encode('utf-8')
+    elif value.__class__ is list:
+        return [_decode_value(element) for element in value]
+
+    return value
+
+def _decode_pairs(pairs):
+    """object_pairs_hook for JSON_DECODER, building each json object with decoded keys and values."""
+
+    obj = {}
+    for key, value in pairs:
+        key = key.encode('utf-8')
+
+        # exact type checks are faster than isinstance, json only produces these types
+        if value.__class__ is unicode:
+            obj[key] = UUID(value) if key in UUID_FIELDS else value.encode('utf-8')
+        elif value.__class__ is list:
+            obj[key] = [_decode_value(element) for element in value]
+        else:
+            obj[key] = value
+
+    return obj
+
+# names of the json fields holding uuids
+UUID_FIELDS = frozenset(["dir_uuid"])
+JSON_DECODER = json.JSONDecoder(object_pairs_hook=_decode_pairs)
+
 def make_dirs_if_not_existent(filepath):
     """Create a directory tree if not already existing."""
 
     if not os.path.exists(filepath):
         os.makedirs(filepath)
 
+def iter_dir_entries(dirpath):
+    """Yield (path, is_dir) for each entry inside dirpath, using the file type returned by scandir
+    when available instead of a stat call per entry. Raises OSError if dirpath can't be listed."""
+
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            yield entry.path, entry.is_dir()
+        return
+
+    for fname in os.listdir(dirpath):
+        path = os.path.join(dirpath, fname)
+        yield path, os.path.isdir(path)
+
+def iter_dir_stats(dirpath, names=None):
+    """Yield (name, stat result) for each entry inside dirpath, or only for the entries in 'names' if provided,
+    reusing the stat cached by scandir entries when available (free on Windows). Missing entries are skipped.
+    Raises OSError if dirpath has to be listed and can't be."""
+
+    if names is not None and (scandir is None or os.name != "nt"):
+        # scandir entries are stat'ed with a syscall each outside of Windows, only stat the wanted ones
+        for fname in names:
+            try:
+                yield fname, os.stat(os.path.join(dirpath, fname))
+            except OSError:
+                pass
+        return
+
+    if names is not None:
+        names = set(names)
+
+    if scandir is not None:
+        for entry in scandir(dirpath):
+            if names is not None and entry.name not in names:
+                continue
+            try:
+                yield entry.name, entry.stat()
+            except OSError:
+                pass
+        return
+
+    for fname in os.listdir(dirpath):
+        try:
+            yield fname, os.stat(os.path.join(dirpath, fname))
+        except OSError:
+            pass
+
 def clamp(val, min, max):
     """Clamp the value between min and max."""
 
@@ -136,3 +237,28 @@ def clamp(val, min, max):
         return max
 
     return val
+
+if __name__ == "__main__":
+    """Example usage for this module."""
+
+    import timeit
+    import uuid
+
+    # strings are decoded to str and uuid fields to UUID objects
+    print json_loads('[{"dirpath": "C:\\\\test_folder", "dir_uuid": "12345678-1234-5678-1234-567812345678"}]')
+
+    # synthetic dbase: folder descriptors and file records
+    descriptors = json.dumps([{"dirpath": r'C:\folder_{}'.format(i), "dir_uuid": str(uuid.uuid4())} for i in range(20000)])
+    records = [json.dumps({"fname": "file_{}.txt".format(i), "tags": ["text", "important", "tag_{}".format(i % 100)]}) for i in range(20000)]
+
+    # the two-pass path has to convert the uuids afterwards to return the same result
+    two_pass_descriptors = lambda: [dict(d, dir_uuid=UUID(d["dir_uuid"])) for d in json_decode(json.loads(descriptors))]
+
+    assert json_loads(descriptors) == two_pass_descriptors()
+    assert [json_loads(r) for r in records] == [json_decode(json.loads(r)) for r in records]
+
+    for name, two_pass, one_pass in (("descriptors", two_pass_descriptors, lambda: json_loads(descriptors)),
+                                     ("records", lambda: [json_decode(json.loads(r)) for r in records], lambda: [json_loads(r) for r in records])):
+        two_pass_time = timeit.timeit(two_pass, number=3) / 3
+        one_pass_time = timeit.timeit(one_pass, number=3) / 3
+        print "{}: two passes {:.3f}s, json_loads {:.3f}s ({:.1f}x)".format(name, two_pass_time, one_pass_time, two_pass_time / one_pass_time)